@@ -4,41 +4,87 @@ from contextlib import closing
 import datetime
 import os
 
-import tweepy
-from boto.s3.connection import S3Connection
-import pymongo
-
 from credentials import Credentials
 from collector import Collector
-from facets import FilteringFacet
+from facets import DedupFacet, FilteringFacet, HeavyHittersFacet, ProjectingFacet
+from indexes import IndexManager
 from matchers import RegexMatcher
-from sinks import MongoDBSink
+from metrics import LogReporter, PrometheusReporter
+from sinks import InstrumentedSink, MongoDBSink, PartitionedMongoDBSink
+from spill import SpillingSink
 
-def main():
+def main(track_trending=False, metrics_port=None, partition=None,
+         metrics_host='127.0.0.1'):
     query_terms=['#NBAFinals2015', '#Warriors']
+    # report metrics every minute, or serve them to prometheus
+    if metrics_port:
+        reporter = PrometheusReporter(port=metrics_port,
+                                      host=metrics_host).start()
+    else:
+        reporter = LogReporter().start()
+    # defer building indexes until collection is finished
+    indexes = IndexManager()
     # We only need a single mongodb sink; FilteringFacet will just let us
     # avoid storing non-matching tweets
-    sink = MongoDBSink('db_restT')
+    # with partition='day' or 'week', tweets go to a collection per day
+    # or week (tweets_20150617, tweets_2015w25), so that date ranges can
+    # be queried and old tweets dropped a collection at a time
+    # tweets are upserted by id, since replaying spilled records can
+    # write some of them again
+    if partition:
+        tweets = PartitionedMongoDBSink('db_restT', partition, indexes,
+                                        key='id')
+    else:
+        tweets = MongoDBSink('db_restT', indexes, key='id')
+    # spill to local disk if mongodb is down, replaying once it's back
+    sink = SpillingSink(
+        InstrumentedSink('tweets', tweets),
+        os.path.expanduser('~/.hw3_spill/db_restT.tweets'))
     sink.open('tweets')
-    # closing ensures any files written get flushed/closed.
-    with closing(
-            FilteringFacet(
-                RegexMatcher('(' + '|'.join(query_terms) + ')'),
-                lambda key: sink)) as facet:
-        creds = Credentials(os.path.expanduser('~/.tweepy'))
-        auth = tweepy.AppAuthHandler(creds.consumer_key, creds.consumer_secret)
-        collector = Collector(auth, facet)
+    # full user objects are stored once each, in their own collection;
+    # users are written before their tweets, so they spill too
+    users = SpillingSink(
+        InstrumentedSink(
+            'tweet_users',
+            MongoDBSink('db_restT', indexes, key='id', text_index=False)),
+        os.path.expanduser('~/.hw3_spill/db_restT.tweet_users'))
+    users.open('tweet_users')
+    # store only the fields we use
+    facet = ProjectingFacet(
+        FilteringFacet(
+            RegexMatcher('(' + '|'.join(query_terms) + ')'),
+            lambda key: sink),
+        user_sink=users)
+    if track_trending:
+        # snapshot the top retweets, hashtags and users as we go
+        trending = MongoDBSink('db_restT', indexes, text_index=False)
+        trending.open('trending')
+        facet = HeavyHittersFacet(trending, facet)
+    # drop tweets seen before (eg from overlapping searches) before
+    # anything else sees them, so they are neither counted nor written
+    facet = DedupFacet(facet)
+    try:
+        # closing ensures any files written get flushed/closed.
+        with closing(facet) as facet:
+            import tweepy
+            creds = Credentials(os.path.expanduser('~/.tweepy'))
+            auth = tweepy.AppAuthHandler(creds.consumer_key, creds.consumer_secret)
+            collector = Collector(auth, facet)
         
-        today = datetime.date.today()
-        week = datetime.timedelta(7)
+            today = datetime.date.today()
+            week = datetime.timedelta(7)
 
-        query_ops={}
-        query_ops['lang'] = 'en'
-        query_ops['result_type'] = 'mixed'
+            query_ops={}
+            query_ops['lang'] = 'en'
+            query_ops['result_type'] = 'mixed'
         
-        print("Starting search")
-        collector.search(query_terms=query_terms,
-                         query_ops=query_ops)
-        print('All done!  Last ID processed={0}'.format(collector.last_id))
+            print("Starting search")
+            collector.search(query_terms=query_terms,
+                             query_ops=query_ops)
+            print('All done!  Last ID processed={0}'.format(collector.last_id))
+    finally:
+        # build indexes even if collection stopped early
+        indexes.build()
+        reporter.stop()
 if __name__ == '__main__':
     main()
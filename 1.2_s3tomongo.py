@@ -1,28 +1,35 @@
 #!/opt/anaconda/bin/python
 from __future__ import print_function
-import os
 import json
-import pymongo
-from boto.s3.connection import S3Connection
-from boto.s3.key import Key
-from credentials import Credentials
+from connections import aws_s3_connection, mongo_client
+from retweets import RetweetCounter
 
 def main():
-    dbclient = pymongo.MongoClient()
+    dbclient = mongo_client()
     dbclient.db_tweets.drop_collection('tweets')
-    creds = Credentials(os.path.expanduser('~/.aws/credentials'))
-    conn = S3Connection(
-        creds.default_aws_access_key_id,
-        creds.default_aws_secret_access_key)
+    dbclient.db_tweets.drop_collection('retweet_counts')
+    counter = RetweetCounter(dbclient.db_tweets.retweet_counts)
+    # the chunked files can overlap, so skip tweets already loaded; this
+    # is a one-off load, so remember every id rather than risk dropping
+    # tweets (and their retweet counts) on a filter's false positives
+    seen = set()
+    conn = aws_s3_connection()
     bucket = conn.lookup('nkrishna-mids205-hw2')
     for key in bucket.list():
         if key.name.endswith('.jsn'):
             try:
                 print("Copying tweets from", key.name)
-                tweets = json.loads(key.get_contents_as_string())
-                dbclient.db_tweets.tweets.insert_many(tweets)
+                tweets = []
+                for tweet in json.loads(key.get_contents_as_string()):
+                    if tweet['id'] not in seen:
+                        seen.add(tweet['id'])
+                        tweets.append(tweet)
+                if tweets:
+                    dbclient.db_tweets.tweets.insert_many(tweets)
+                counter.add_many(tweets)
             finally:
                 pass
+    counter.flush()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,50 @@
+from __future__ import print_function
+
+import os
+import sys
+
+from connections import mongo_client
+from credentials import Credentials
+from followers import FollowerStore, FollowerTracker
+
+def main(rounds=1, interval=24*60*60):
+    """Snapshot the followers of the top 10 users of db_followers for
+    `rounds` rounds, `interval` seconds apart.  The default single round
+    suits a daily cron job, eg
+
+        0 0 * * * python 2.2_track_followers.py
+
+    """
+    import tweepy
+    creds = Credentials(os.path.expanduser('~/.tweepy'))
+    auth = tweepy.AppAuthHandler(creds.consumer_key, creds.consumer_secret)
+    api = tweepy.API(auth_handler=auth,
+                     compression=True,
+                     retry_errors=set((104,)),
+                     retry_count=100,
+                     timeout=3600,
+                     wait_on_rate_limit=True,
+                     wait_on_rate_limit_notify=True)
+    dbclient = mongo_client()
+    # kept out of db_followers, which proc drops, so history survives re-runs
+    history = dbclient.db_follower_history
+    tracker = FollowerTracker(FollowerStore(history.tracked_followers),
+                              history.snapshots)
+
+    def fetch_followers(user):
+        while True:
+            try:
+                return list(tweepy.Cursor(api.followers_ids,
+                                          count=5000,
+                                          user_id=user).items())
+            except tweepy.TweepError as e:
+                if e.response is not None and e.response.status == 104:
+                    continue
+                raise
+
+    users = [row['_id'] for row in dbclient.db_followers.top_rt_followers.find(
+        {}, sort=[('initial_count', -1)]).limit(10)]
+    tracker.run(users, fetch_followers, interval=interval, rounds=rounds)
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
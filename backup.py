@@ -0,0 +1,456 @@
+from __future__ import print_function
+import unittest
+
+from collections import deque
+from io import BytesIO
+from multiprocessing.pool import ThreadPool
+import datetime
+import struct
+import zlib
+
+import bson
+from bson import json_util
+from bson.objectid import ObjectId
+import pymongo
+
+from connections import mongo_client
+
+# S3 requires every part of a multipart upload but the last to be >= 5MB
+MIN_PART_BYTES = 5 * 1024 * 1024
+
+_FRAME_HEADER = struct.Struct('>I')
+
+def _bounded_imap(pool, fn, iterable, window):
+    """Like `pool.imap(fn, iterable)`, but with at most `window` items
+    submitted and not yet consumed, so that memory use stays bounded
+    however long `iterable` is.
+
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append(pool.apply_async(fn, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+def _bson_chunks(cursor, chunk_bytes):
+    """Yield the documents from `cursor` as concatenated BSON, in chunks
+    of about `chunk_bytes` bytes.
+
+    """
+    chunk = []
+    size = 0
+    for doc in cursor:
+        data = bson.BSON.encode(doc)
+        chunk.append(data)
+        size += len(data)
+        if size >= chunk_bytes:
+            yield b''.join(chunk)
+            chunk = []
+            size = 0
+    if chunk:
+        yield b''.join(chunk)
+
+def _compress(chunk):
+    """Return a length-prefixed frame holding `chunk`, compressed"""
+    data = zlib.compress(chunk)
+    return _FRAME_HEADER.pack(len(data)) + data
+
+def _parts(frames, part_bytes):
+    """Group `frames` into (part number, data) pairs of at least
+    `part_bytes` bytes, except for the last.
+
+    """
+    part = []
+    size = 0
+    part_num = 1
+    for frame in frames:
+        part.append(frame)
+        size += len(frame)
+        if size >= part_bytes:
+            yield (part_num, b''.join(part))
+            part = []
+            size = 0
+            part_num += 1
+    if part or part_num == 1:
+        yield (part_num, b''.join(part))
+
+def _read_exactly(key, size):
+    data = b''
+    while len(data) < size:
+        more = key.read(size - len(data))
+        if not more:
+            raise IOError("Truncated backup object: {0}".format(key.name))
+        data += more
+    return data
+
+def _read_frames(key):
+    """Yield the compressed frames stored in S3 key `key`, streaming"""
+    while True:
+        header = key.read(_FRAME_HEADER.size)
+        if not header:
+            break
+        if len(header) < _FRAME_HEADER.size:
+            header += _read_exactly(key, _FRAME_HEADER.size - len(header))
+        (size,) = _FRAME_HEADER.unpack(header)
+        yield _read_exactly(key, size)
+    key.close()
+
+def _index_specs(coll):
+    """Return the secondary indexes of `coll` as a JSON-serializable list
+    of (keys, options) pairs suitable for `create_index`.
+
+    """
+    specs = []
+    for (name, info) in coll.index_information().items():
+        if name == '_id_':
+            continue
+        keys = [list(k) for k in info['key']]
+        if any(field == '_fts' for (field, _) in keys):
+            # text indexes report their fields as weights
+            keys = ([k for k in keys if k[0] not in ('_fts', '_ftsx')] +
+                    [[field, pymongo.TEXT] for field in info['weights']])
+        options = dict((k, v) for (k, v) in info.items()
+                       if k not in ('key', 'v', 'ns', 'background'))
+        options['name'] = name
+        specs.append([keys, options])
+    return specs
+
+def _restore_indexes(coll, specs):
+    for (keys, options) in specs:
+        coll.create_index([tuple(k) for k in keys], **options)
+
+class Backup(object):
+    """Streams MongoDB databases to and from S3 without staging them on
+    local disk.
+
+    Each collection is read with a cursor, encoded as BSON in chunks of
+    about `chunk_bytes`, and each chunk is compressed as a separate
+    length-prefixed zlib frame by a pool of `workers` threads (zlib
+    releases the GIL).  Frames are uploaded, `part_bytes` at a time, as
+    the parts of a multipart upload, also in parallel.
+
+    Each backup of a collection stores a full segment,
+    `<prefix><db>/<collection>.<n>.bson.z`, unless the collection is
+    named ('<db>.<collection>') in `incremental`.  Those are stored as a
+    base segment followed by delta segments, each holding the documents
+    whose `_id` is above the previous segment's watermark (its highest
+    `_id`) and at most its own.  Only list append-only collections with
+    `ObjectId` ids, such as db_tweets.tweets: updates and deletes of
+    documents already backed up, and inserts below the watermark, are
+    not captured.  Collections whose ids turn out not to be `ObjectId`s
+    are backed up in full.  `backup_db(db, full=True)` takes new base
+    segments; so does a backup after `rebase_every` deltas, or of a
+    collection with fewer documents than its segments hold (eg it was
+    dropped and rebuilt).  The manifest, `<prefix><db>/manifest.json`,
+    lists each collection's segments and indexes.  Segment numbers only
+    increase, so a new base never overwrites a segment the current
+    manifest refers to, and segments left out of the new manifest are
+    deleted only once it has been written: a backup that fails part way
+    leaves the last one intact.
+
+    Restoring reverses this: each segment is streamed from S3 in turn,
+    its frames decompressed and inserted with `insert_many` in
+    parallel, and indexes are built once all documents are loaded.
+
+    """
+    def __init__(self, bucket, prefix='', workers=4,
+                 chunk_bytes=4*1024*1024, part_bytes=8*1024*1024,
+                 rebase_every=30, incremental=()):
+        self.bucket = bucket
+        self.incremental = set(incremental)
+        self.prefix = prefix
+        self.workers = workers
+        self.chunk_bytes = chunk_bytes
+        self.part_bytes = max(part_bytes, MIN_PART_BYTES)
+        self.rebase_every = rebase_every
+    def manifest_name(self, dbname):
+        return '{0}{1}/manifest.json'.format(self.prefix, dbname)
+    def segment_name(self, dbname, collname, segment):
+        return '{0}{1}/{2}.{3}.bson.z'.format(self.prefix, dbname, collname,
+                                             segment)
+    def read_manifest(self, dbname):
+        key = self.bucket.get_key(self.manifest_name(dbname))
+        if key is None:
+            return None
+        return json_util.loads(key.get_contents_as_string().decode('utf-8'))
+    def write_manifest(self, dbname, manifest):
+        self.bucket.new_key(self.manifest_name(dbname)).set_contents_from_string(
+            json_util.dumps(manifest, indent=1, sort_keys=True))
+    def upload(self, key_name, chunks, pool):
+        """Compress `chunks` and upload them to `key_name` as a multipart
+        upload, returning the number of bytes uploaded.
+
+        """
+        window = 2 * self.workers
+        frames = _bounded_imap(pool, _compress, chunks, window)
+        mp = self.bucket.initiate_multipart_upload(key_name)
+        def upload_part(part):
+            (part_num, data) = part
+            mp.upload_part_from_file(BytesIO(data), part_num)
+            return len(data)
+        try:
+            size = sum(_bounded_imap(pool, upload_part,
+                                     _parts(frames, self.part_bytes),
+                                     window))
+        except:
+            mp.cancel_upload()
+            raise
+        mp.complete_upload()
+        return size
+    def backup_collection(self, coll, pool, entry=None, full=False,
+                          incremental=False):
+        """Upload the documents of `coll`: if `incremental`, those added
+        since the last segment of its manifest `entry` (or all of them
+        if there is no entry, or `full`), otherwise all of them.
+        Returns the updated manifest entry.
+
+        """
+        segments = []
+        if entry and incremental and not full:
+            segments = entry['segments']
+        # segment numbers are never reused, not even by a new base, so
+        # the segments of the last manifest are intact until it is replaced
+        number = entry['segments'][-1]['segment'] + 1 if entry else 0
+        watermark = None
+        if incremental:
+            last = coll.find_one({}, projection={'_id': True},
+                                 sort=[('_id', pymongo.DESCENDING)])
+            watermark = last['_id'] if last else None
+            if watermark is not None and not isinstance(watermark, ObjectId):
+                print("{0}.{1} ids are not ObjectIds, backing up in full"
+                      .format(coll.database.name, coll.name))
+                (segments, watermark) = ([], None)
+        if segments:
+            stored = sum(segment['count'] for segment in segments)
+            previous = segments[-1]['watermark']
+            if (previous is None or
+                    len(segments) > self.rebase_every or
+                    coll.count() < stored):
+                segments = []
+            elif watermark == previous:
+                return {'segments': segments, 'indexes': _index_specs(coll)}
+        if segments:
+            query = {'_id': {'$gt': segments[-1]['watermark'],
+                             '$lte': watermark}}
+        elif watermark is not None:
+            query = {'_id': {'$lte': watermark}}
+        else:
+            query = {}
+        key_name = self.segment_name(coll.database.name, coll.name, number)
+        counted = [0]
+        def count(cursor):
+            for doc in cursor:
+                counted[0] += 1
+                yield doc
+        chunks = _bson_chunks(count(coll.find(query)), self.chunk_bytes)
+        size = self.upload(key_name, chunks, pool)
+        segments = segments + [{'segment': number,
+                                'key': key_name,
+                                'count': counted[0],
+                                'bytes': size,
+                                'watermark': watermark,
+                                'date': datetime.datetime.utcnow()}]
+        return {'segments': segments, 'indexes': _index_specs(coll)}
+    def backup_db(self, db, full=False):
+        """Back up the documents added to each collection of `db` since its
+        last backup, or all of them if `full`.  Returns the manifest.
+
+        """
+        manifest = self.read_manifest(db.name)
+        if manifest is None:
+            manifest = {'db': db.name, 'collections': {}}
+        old = manifest['collections']
+        manifest['collections'] = {}
+        manifest['date'] = datetime.datetime.utcnow()
+        pool = ThreadPool(self.workers)
+        try:
+            for collname in db.collection_names(
+                    include_system_collections=False):
+                print("Backing up {0}.{1}".format(db.name, collname))
+                manifest['collections'][collname] = self.backup_collection(
+                    db[collname], pool, old.get(collname), full,
+                    '{0}.{1}'.format(db.name, collname) in self.incremental)
+        finally:
+            pool.close()
+            pool.join()
+        self.write_manifest(db.name, manifest)
+        # remove segments that are no longer part of the backup
+        kept = set(segment['key']
+                   for entry in manifest['collections'].values()
+                   for segment in entry['segments'])
+        for entry in old.values():
+            for segment in entry['segments']:
+                if segment['key'] not in kept:
+                    self.bucket.delete_key(segment['key'])
+        return manifest
+    def restore_collection(self, coll, key_name, pool):
+        """Insert the documents stored in `key_name` into `coll`,
+        returning the number inserted.
+
+        """
+        def insert(frame):
+            docs = bson.decode_all(zlib.decompress(frame))
+            if docs:
+                coll.insert_many(docs, ordered=False)
+            return len(docs)
+        key = self.bucket.get_key(key_name)
+        return sum(_bounded_imap(pool, insert, _read_frames(key),
+                                 2 * self.workers))
+    def restore_db(self, db, drop=True):
+        """Restore `db` from its base and delta segments, dropping each
+        collection first if `drop`.  Returns the manifest.
+
+        """
+        manifest = self.read_manifest(db.name)
+        if manifest is None:
+            raise KeyError("No backup of {0} at {1}".format(
+                db.name, self.manifest_name(db.name)))
+        pool = ThreadPool(self.workers)
+        try:
+            for (collname, entry) in manifest['collections'].items():
+                print("Restoring {0}.{1}".format(db.name, collname))
+                if drop:
+                    db.drop_collection(collname)
+                for segment in entry['segments']:
+                    self.restore_collection(db[collname], segment['key'],
+                                            pool)
+                _restore_indexes(db[collname], entry['indexes'])
+        finally:
+            pool.close()
+            pool.join()
+        return manifest
+
+class BackupTest(unittest.TestCase):
+    def setUp(self):
+        from fakes import FakeS3Connection
+        self.bucket = FakeS3Connection().create_bucket('test-backups')
+        self.db = mongo_client().test_backup_db
+        self.db.tweets.insert_many(
+            [{'n': i, 'text': 'tweet number {0}'.format(i), 'user': i % 7}
+             for i in range(1000)])
+        self.db.tweets.create_index('user')
+        self.db.tweets.create_index([('text', pymongo.TEXT)])
+        self.db.users.insert_one({'_id': 300, 'name': 'someone'})
+
+    def incremental(self, **options):
+        return Backup(self.bucket, incremental=['test_backup_db.tweets'],
+                      **options)
+
+    def test_parts(self):
+        self.assertEqual(list(_parts([b'ab', b'c', b'de', b'f'], 3)),
+                         [(1, b'abc'), (2, b'def')])
+        self.assertEqual(list(_parts([], 3)), [(1, b'')])
+
+    def test_backup_restore(self):
+        backup = Backup(self.bucket, prefix='backups/', workers=3,
+                        chunk_bytes=1000)
+        # exercise multipart uploads with small parts
+        backup.part_bytes = 5000
+        manifest = backup.backup_db(self.db)
+        self.assertEqual(
+            manifest['collections']['tweets']['segments'][0]['count'], 1000)
+        self.assertEqual(
+            manifest['collections']['users']['segments'][0]['count'], 1)
+        self.assertEqual(
+            backup.read_manifest('test_backup_db')['collections']['tweets'][
+                'segments'][0]['key'],
+            'backups/test_backup_db/tweets.0.bson.z')
+        self.assertTrue(self.bucket.get_key(
+            'backups/test_backup_db/tweets.0.bson.z').size > 5000)
+
+        mongo_client().drop_database('test_backup_db')
+        backup.restore_db(self.db)
+        self.assertEqual(self.db.tweets.count(), 1000)
+        self.assertEqual(self.db.tweets.find_one({'n': 42})['text'],
+                         'tweet number 42')
+        self.assertEqual(self.db.users.find_one({'_id': 300})['name'],
+                         'someone')
+        self.assertTrue('user_1' in self.db.tweets.index_information())
+
+    def test_incremental(self):
+        backup = self.incremental(workers=2, rebase_every=2)
+        backup.backup_db(self.db)
+        self.db.tweets.insert_many([{'n': i, 'text': 'later'}
+                                    for i in range(1000, 1100)])
+        manifest = backup.backup_db(self.db)
+        segments = manifest['collections']['tweets']['segments']
+        self.assertEqual([(s['segment'], s['count']) for s in segments],
+                         [(0, 1000), (1, 100)])
+        self.assertEqual(segments[1]['watermark'],
+                         self.db.tweets.find_one({'n': 1099})['_id'])
+        # nothing new: no new segments
+        manifest = backup.backup_db(self.db)
+        self.assertEqual(
+            len(manifest['collections']['tweets']['segments']), 2)
+
+        mongo_client().drop_database('test_backup_db')
+        backup.restore_db(self.db)
+        self.assertEqual(self.db.tweets.count(), 1100)
+        self.assertEqual(self.db.tweets.find_one({'n': 1050})['text'],
+                         'later')
+
+        # a shrunken collection gets a new base, and old segments go
+        self.db.tweets.delete_many({'n': {'$lt': 500}})
+        manifest = backup.backup_db(self.db)
+        segments = manifest['collections']['tweets']['segments']
+        self.assertEqual([(s['segment'], s['count']) for s in segments],
+                         [(2, 600)])
+        for n in (0, 1):
+            self.assertEqual(self.bucket.get_key(
+                'test_backup_db/tweets.{0}.bson.z'.format(n)), None)
+
+    def test_full(self):
+        backup = self.incremental()
+        backup.backup_db(self.db)
+        # users are not incremental: updates and inserts below the
+        # highest id are backed up
+        self.db.users.update_one({'_id': 300}, {'$set': {'name': 'renamed'}})
+        self.db.users.insert_one({'_id': 200, 'name': 'new'})
+        manifest = backup.backup_db(self.db)
+        self.assertEqual([(s['segment'], s['count']) for s in
+                          manifest['collections']['users']['segments']],
+                         [(1, 2)])
+        # nor is a collection listed as incremental without ObjectIds
+        self.db.counts.insert_one({'_id': 1, 'count': 1})
+        backup = Backup(self.bucket, incremental=['test_backup_db.counts'])
+        backup.backup_db(self.db)
+        self.db.counts.update_one({'_id': 1}, {'$set': {'count': 2}})
+        backup.backup_db(self.db)
+        mongo_client().drop_database('test_backup_db')
+        backup.restore_db(self.db)
+        self.assertEqual(sorted((u['_id'], u['name'])
+                                for u in self.db.users.find()),
+                         [(200, 'new'), (300, 'renamed')])
+        self.assertEqual(self.db.counts.find_one()['count'], 2)
+
+    def test_failed_rebase(self):
+        backup = self.incremental(workers=2)
+        backup.backup_db(self.db)
+        self.db.tweets.insert_many([{'n': i, 'text': 'later'}
+                                    for i in range(1000, 1100)])
+        backup.backup_db(self.db)
+        # tweets get a new base, then backing up users fails
+        self.db.tweets.delete_many({'n': {'$lt': 500}})
+        backup_collection = backup.backup_collection
+        def failing(coll, *args):
+            if coll.name == 'users':
+                raise IOError("injected")
+            return backup_collection(coll, *args)
+        backup.backup_collection = failing
+        with self.assertRaises(IOError):
+            backup.backup_db(self.db)
+        # the last good backup is intact
+        mongo_client().drop_database('test_backup_db')
+        Backup(self.bucket).restore_db(self.db)
+        self.assertEqual(self.db.tweets.count(), 1100)
+        self.assertEqual(self.db.users.count(), 1)
+
+    def tearDown(self):
+        mongo_client().drop_database('test_backup_db')
+
+def main():
+    unittest.main()
+if __name__ == '__main__':
+    main()
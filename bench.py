@@ -0,0 +1,433 @@
+#!/opt/anaconda/bin/python
+"""Offline ingest benchmarks.  Recorded or synthetic tweets are replayed
+through `Collector`'s emit path, a `FilteringFacet` with a
+`RegexMatcher`, and each sink chain, with local stand-ins for the
+services: a temp directory for files, `fakes.FakeS3Connection` for S3,
+and mongomock (or a local mongod, with --mongo-uri) for MongoDB.
+
+For each configuration we report tweets per second (including closing
+the facet, so buffered writes are counted), p50/p99 emit latency and
+peak RSS.  Each configuration runs in its own process, so that peak RSS
+is its own; the tweets replayed are held in memory, so compare RSS
+between configurations rather than reading it as an absolute cost.
+mongomock finds documents to upsert by scanning the collection, so
+keyed sinks (eg the users in `acq`) slow down as they grow; use a
+local mongod for figures comparable with production.
+
+    python bench.py                       # every configuration
+    python bench.py --config file s3      # just these
+    python bench.py --tweets chunk.jsn    # replay recorded tweets
+    python bench.py --save base.json      # ...and later:
+    python bench.py --baseline base.json  # exit 1 on a regression
+    python bench.py --startup             # cold start of each entry point
+
+"""
+from __future__ import print_function
+
+import argparse
+from contextlib import closing
+import datetime
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import tweepy
+
+from collector import Collector
+from facets import DedupFacet, Facet, FilteringFacet, ProjectingFacet
+from fakes import FakeS3Connection
+from matchers import RegexMatcher
+from sinks import (InstrumentedSink, MongoDBSink, PartitionedMongoDBSink,
+                   RecordSink, RollingSink, S3Sink, Sink, FileSink)
+from spill import SpillingSink
+
+QUERY_TERMS = ['#NBAFinals2015', '#Warriors']
+PAGE_SIZE = 100
+DB_NAME = 'bench_ingest'
+
+_WORDS = ('the game tonight was great what a shot by curry lebron is '
+          'playing hard defense wins championships oracle arena dubnation '
+          'cavs in six no way finals mvp iguodala splash brothers').split()
+_TAGS = QUERY_TERMS + ['#NBA', '#Cavs', '#StrengthInNumbers']
+
+def synthetic_tweets(count, match_rate=0.5, retweet_rate=0.3,
+                     duplicate_rate=0.05, users=5000, seed=205):
+    """Return `count` tweets shaped like those the search API returns.
+    About `match_rate` of them mention a query term, `retweet_rate` are
+    retweets (and carry the original), and `duplicate_rate` repeat an
+    earlier tweet, as overlapping searches do.
+
+    """
+    rng = random.Random(seed)
+    start = datetime.datetime(2015, 6, 4)
+    tweets = []
+    for i in range(count):
+        if tweets and rng.random() < duplicate_rate:
+            tweets.append(rng.choice(tweets))
+            continue
+        words = [rng.choice(_WORDS) for _ in range(rng.randint(6, 18))]
+        if rng.random() < match_rate:
+            words.insert(rng.randint(0, len(words)), rng.choice(QUERY_TERMS))
+        else:
+            words.append(rng.choice(_TAGS[2:]))
+        text = ' '.join(words)
+        tweet = _tweet(rng, 600000000000000000 + i, start, i, count, text,
+                       users)
+        if rng.random() < retweet_rate:
+            original = _tweet(rng, 500000000000000000 + rng.randint(0, 999),
+                              start, 0, count, text, users)
+            tweet['retweeted_status'] = original
+            tweet['text'] = u'RT @{0}: {1}'.format(
+                original['user']['screen_name'], text)[:140]
+        tweets.append(tweet)
+    return tweets
+
+def _tweet(rng, id, start, i, count, text, users):
+    created = start + datetime.timedelta(days=14.0 * i / max(count, 1))
+    userid = rng.randint(1, users)
+    hashtags = [{'text': w[1:], 'indices': [0, len(w)]}
+                for w in text.split() if w.startswith('#')]
+    return {
+        'id': id,
+        'id_str': str(id),
+        'created_at': created.strftime('%a %b %d %H:%M:%S +0000 %Y'),
+        'text': text,
+        'lang': 'en',
+        'source': '<a href="http://twitter.com" rel="nofollow">Twitter</a>',
+        'truncated': False,
+        'in_reply_to_status_id': None,
+        'in_reply_to_user_id': None,
+        'retweet_count': rng.randint(0, 500),
+        'favorite_count': rng.randint(0, 500),
+        'favorited': False,
+        'retweeted': False,
+        'entities': {'hashtags': hashtags, 'urls': [], 'user_mentions': [],
+                     'symbols': []},
+        'metadata': {'iso_language_code': 'en', 'result_type': 'recent'},
+        'user': {
+            'id': userid,
+            'id_str': str(userid),
+            'name': 'User {0}'.format(userid),
+            'screen_name': 'user{0}'.format(userid),
+            'location': 'Oakland, CA',
+            'description': ' '.join(rng.choice(_WORDS) for _ in range(12)),
+            'followers_count': rng.randint(0, 100000),
+            'friends_count': rng.randint(0, 5000),
+            'statuses_count': rng.randint(0, 50000),
+            'created_at': 'Mon Jan 04 18:00:00 +0000 2010',
+            'lang': 'en',
+            'verified': False,
+            'profile_image_url': 'http://pbs.twimg.com/profile_images/'
+                                 '{0}/photo_normal.jpg'.format(userid),
+            'profile_background_color': 'C0DEED',
+            'profile_text_color': '333333',
+        },
+    }
+
+def load_tweets(filename):
+    """Load recorded tweets from `filename`, either a JSON array (as
+    written by `RecordSink`) or one JSON tweet per line.
+
+    """
+    with open(filename) as f:
+        data = f.read()
+    if data.lstrip().startswith('['):
+        return json.loads(data)
+    return [json.loads(line) for line in data.splitlines() if line.strip()]
+
+def pages(tweets, size=PAGE_SIZE):
+    """Parse `tweets` into pages of statuses, as the search API does"""
+    statuses = [tweepy.models.Status.parse(None, tweet) for tweet in tweets]
+    return [statuses[i:i+size] for i in range(0, len(statuses), size)]
+
+class NullSink(Sink):
+    """A sink that discards its records, to time the facets alone"""
+    def open(self, *args):
+        pass
+    def write(self, string):
+        pass
+    def flush(self):
+        pass
+    def close(self):
+        pass
+
+class TimedFacet(Facet):
+    """Passes tweets on to `facet`, recording the latency of each emit"""
+    def __init__(self, facet):
+        self.facet = facet
+        self.latencies = []
+    def emit(self, tweet):
+        start = time.time()
+        result = self.facet.emit(tweet)
+        self.latencies.append(time.time() - start)
+        return result
+    def close(self):
+        self.facet.close()
+
+def _mongo_client(uri):
+    if uri:
+        import pymongo
+        client = pymongo.MongoClient(uri)
+        client.drop_database(DB_NAME)
+        return client
+    import mongomock
+    return mongomock.MongoClient()
+
+def _filtering(make_sink):
+    return FilteringFacet(RegexMatcher('(' + '|'.join(QUERY_TERMS) + ')'),
+                          make_sink)
+
+def _opened(sink, *args):
+    sink.open(*args)
+    return sink
+
+def _null(tmpdir, mongo_uri):
+    sink = NullSink()
+    return _filtering(lambda key: sink)
+
+def _file(tmpdir, mongo_uri):
+    return _filtering(lambda key: RollingSink(
+        os.path.join(tmpdir, key, 'tweets.{0}.jsn'), 1000,
+        RecordSink(FileSink())))
+
+def _s3(tmpdir, mongo_uri):
+    conn = FakeS3Connection()
+    return _filtering(lambda key: RollingSink(
+        key + '/tweets.{0}.jsn', 1000,
+        RecordSink(S3Sink(conn, 'bench-ingest'))))
+
+def _mongo(tmpdir, mongo_uri):
+    sink = _opened(MongoDBSink(DB_NAME, dbclient=_mongo_client(mongo_uri)),
+                   'tweets')
+    return _filtering(lambda key: sink)
+
+def _partitioned(tmpdir, mongo_uri):
+    sink = _opened(PartitionedMongoDBSink(DB_NAME,
+                                          dbclient=_mongo_client(mongo_uri)),
+                   'tweets')
+    return _filtering(lambda key: sink)
+
+def _acq(tmpdir, mongo_uri):
+    # the chain in 1.1_acq.py
+    client = _mongo_client(mongo_uri)
+    sink = _opened(SpillingSink(
+        InstrumentedSink('tweets', MongoDBSink(DB_NAME, dbclient=client)),
+        os.path.join(tmpdir, 'spill')), 'tweets')
+    users = _opened(SpillingSink(InstrumentedSink(
+        'tweet_users',
+        MongoDBSink(DB_NAME, dbclient=client, key='id', text_index=False)),
+        os.path.join(tmpdir, 'spill_users')), 'tweet_users')
+    return DedupFacet(ProjectingFacet(_filtering(lambda key: sink),
+                                      user_sink=users))
+
+# name -> (description, function of (tmpdir, mongo_uri) returning a facet)
+CONFIGS = [
+    ('null', ('match only, records discarded', _null)),
+    ('file', ('rolling JSON files in a temp dir', _file)),
+    ('s3', ('rolling JSON files in a fake S3 bucket', _s3)),
+    ('mongo', ('one MongoDB collection', _mongo)),
+    ('daily', ('a MongoDB collection per day', _partitioned)),
+    ('acq', ('1.1_acq chain: dedup, projection, spill, mongo', _acq)),
+]
+CONFIG_NAMES = [name for (name, _) in CONFIGS]
+
+def _peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on OS X
+    if sys.platform == 'darwin':
+        rss /= 1024.0
+    return rss / 1024.0
+
+def _quantile(ordered, q):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+def run(name, tweets, mongo_uri=None):
+    """Replay `tweets` through configuration `name`, returning its
+    results as a dict.
+
+    """
+    make_facet = dict(CONFIGS)[name][1]
+    replayed = pages(tweets)
+    rss_before = _peak_rss_mb()
+    tmpdir = tempfile.mkdtemp(prefix='bench_')
+    try:
+        facet = TimedFacet(make_facet(tmpdir, mongo_uri))
+        collector = Collector(None, facet)
+        start = time.time()
+        with closing(facet):
+            collector.replay(replayed)
+        elapsed = time.time() - start
+    finally:
+        shutil.rmtree(tmpdir)
+    latencies = sorted(facet.latencies)
+    return {'config': name,
+            'tweets': len(tweets),
+            'seconds': elapsed,
+            'tweets_per_sec': len(tweets) / elapsed if elapsed else 0.0,
+            'p50_emit_ms': _quantile(latencies, 0.5) * 1000,
+            'p99_emit_ms': _quantile(latencies, 0.99) * 1000,
+            'peak_rss_mb': _peak_rss_mb(),
+            'rss_growth_mb': _peak_rss_mb() - rss_before}
+
+def run_isolated(name, args):
+    """Run configuration `name` in a child process, returning its results"""
+    command = [sys.executable, os.path.abspath(__file__),
+               '--child', name, '--count', str(args.count)]
+    if args.tweets:
+        command += ['--tweets', args.tweets]
+    if args.mongo_uri:
+        command += ['--mongo-uri', args.mongo_uri]
+    output = subprocess.check_output(command)
+    if not isinstance(output, str):
+        output = output.decode('utf-8')
+    # the last line is ours; sinks may print before it
+    return json.loads(output.strip().splitlines()[-1])
+
+def report(results):
+    print('{0:<8} {1:>8} {2:>12} {3:>10} {4:>10} {5:>10} {6:>10}'.format(
+        'config', 'tweets', 'tweets/sec', 'p50 ms', 'p99 ms',
+        'peak MB', 'growth MB'))
+    for r in results:
+        print('{0:<8} {1:>8} {2:>12.0f} {3:>10.3f} {4:>10.3f} '
+              '{5:>10.1f} {6:>10.1f}'.format(
+                  r['config'], r['tweets'], r['tweets_per_sec'],
+                  r['p50_emit_ms'], r['p99_emit_ms'],
+                  r['peak_rss_mb'], r['rss_growth_mb']))
+
+def regressions(results, baseline, tolerance):
+    """Return descriptions of the results more than `tolerance` (a
+    fraction) worse than `baseline` in throughput or p99 latency.
+
+    """
+    base = dict((r['config'], r) for r in baseline)
+    found = []
+    for r in results:
+        b = base.get(r['config'])
+        if not b:
+            continue
+        if r['tweets_per_sec'] < b['tweets_per_sec'] * (1 - tolerance):
+            found.append('{0}: {1:.0f} tweets/sec, was {2:.0f}'.format(
+                r['config'], r['tweets_per_sec'], b['tweets_per_sec']))
+        if r['p99_emit_ms'] > b['p99_emit_ms'] * (1 + tolerance):
+            found.append('{0}: p99 emit {1:.3f} ms, was {2:.3f}'.format(
+                r['config'], r['p99_emit_ms'], b['p99_emit_ms']))
+    return found
+
+# Entry points, and modules that they and worker processes import
+ENTRY_POINTS = ['1.1_acq.py', '1.2_s3tomongo.py', 'collector.py',
+                'sinks.py', 'spill.py', 'connections.py']
+# Backends that should only be loaded once they are used
+BACKENDS = ['tweepy', 'boto', 'pymongo']
+
+# Loads an entry point (without running its main) in a fresh interpreter,
+# printing the time taken and the backends loaded
+_STARTUP_SCRIPT = """
+import json, runpy, sys, time
+start = time.time()
+runpy.run_path(sys.argv[1], run_name='startup')
+print(json.dumps({'seconds': time.time() - start,
+                  'backends': [m for m in sys.argv[2:] if m in sys.modules]}))
+"""
+
+def _importtime(path):
+    """Return the three slowest top level imports of `path`, as
+    (microseconds, module) pairs, from `python -X importtime` (3.7+).
+
+    """
+    output = subprocess.Popen(
+        [sys.executable, '-X', 'importtime', '-c', _STARTUP_SCRIPT, path],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()[1]
+    imports = []
+    for line in output.decode('utf-8').splitlines():
+        # import time: self [us] | cumulative | imported package
+        fields = line.split('|')
+        if line.startswith('import time:') and len(fields) == 3:
+            name = fields[2].rstrip()
+            if fields[1].strip().isdigit() and not name.startswith('  '):
+                imports.append((int(fields[1]), name.strip()))
+    return sorted(imports, reverse=True)[:3]
+
+def startup(path, repeat=5):
+    """Return the best of `repeat` cold start times of entry point
+    `path`, with the backends it loads.
+
+    """
+    command = [sys.executable, '-c', _STARTUP_SCRIPT, path] + BACKENDS
+    best = None
+    for _ in range(repeat):
+        output = subprocess.check_output(
+            command, cwd=os.path.dirname(os.path.abspath(__file__)))
+        if not isinstance(output, str):
+            output = output.decode('utf-8')
+        result = json.loads(output.strip().splitlines()[-1])
+        if best is None or result['seconds'] < best['seconds']:
+            best = result
+    best['entry_point'] = path
+    if sys.version_info >= (3, 7):
+        best['slowest'] = _importtime(path)
+    return best
+
+def report_startup(results):
+    print('{0:<18} {1:>8}  {2}'.format('entry point', 'ms', 'backends loaded'))
+    for r in results:
+        print('{0:<18} {1:>8.1f}  {2}'.format(
+            r['entry_point'], r['seconds'] * 1000,
+            ', '.join(r['backends']) or '-'))
+        for (us, name) in r.get('slowest', []):
+            print('{0:<18} {1:>8.1f}  {2}'.format('', us / 1000.0, name))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Offline ingest benchmarks')
+    parser.add_argument('--config', nargs='+', choices=CONFIG_NAMES,
+                        default=CONFIG_NAMES)
+    parser.add_argument('--count', type=int, default=5000,
+                        help='synthetic tweets to replay')
+    parser.add_argument('--tweets', help='replay recorded tweets instead')
+    parser.add_argument('--mongo-uri',
+                        help='use this mongod instead of mongomock')
+    parser.add_argument('--save', help='write the results to this file')
+    parser.add_argument('--baseline',
+                        help='compare with results saved by --save')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--startup', action='store_true',
+                        help='time the cold start of each entry point')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.startup:
+        report_startup([startup(path) for path in ENTRY_POINTS])
+        return 0
+
+    if args.child:
+        if args.tweets:
+            tweets = load_tweets(args.tweets)
+        else:
+            tweets = synthetic_tweets(args.count)
+        print(json.dumps(run(args.child, tweets, args.mongo_uri)))
+        return 0
+
+    results = [run_isolated(name, args) for name in args.config]
+    report(results)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.tolerance)
+        for line in found:
+            print('Regression:', line)
+        if found:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
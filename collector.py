@@ -1,15 +1,24 @@
 import datetime
+import time
 from signal import SIGINT
 from pysigset import suspended_signals
 import urllib
 
-import tweepy
-
 from progress.bar import Bar
 from progress.spinner import Spinner
 from progress.counter import Counter
 
-from listeners import EmittingListener
+# tweepy (and the listeners built on it) are imported when a Collector
+# is created, since it takes a while to load
+from metrics import REGISTRY
+
+TWEETS_FETCHED = REGISTRY.counter(
+    'tweets_fetched_total', 'Tweets received from the Twitter API')
+API_PAGE_SECONDS = REGISTRY.histogram(
+    'api_page_seconds', 'Time to fetch a page of search results')
+RATE_LIMIT_SLEEP_SECONDS = REGISTRY.histogram(
+    'rate_limit_sleep_seconds',
+    'Time to fetch a page of search results after exhausting the rate limit')
 
 class _CollectionProgress(object):
     def __init__(self, method, query_ops):
@@ -35,14 +44,21 @@ class _CollectionProgress(object):
         if self.dates:
             days_elapsed = (status.created_at.date() - self.dates[0]).days
             if days_elapsed > self._progress.index:
-                self._progress.next(days_elapsed - progress.index)
+                self._progress.next(days_elapsed - self._progress.index)
         else:
             self._progress.next()
     def finish(self):
         self._progress.finish()
 
+class _NullProgress(object):
+    def next(self, status):
+        pass
+    def finish(self):
+        pass
+
 class Collector(object):
     def __init__(self, auth, facet):
+        import tweepy
         self.last_id = None
         self.auth = auth
         self.api = tweepy.API(auth_handler=self.auth,
@@ -62,29 +78,66 @@ class Collector(object):
         with _CollectionProgress(method, query_ops) as progress:
             method(query_terms, query_ops, page_limit, progress, self.facet)
     def _search(self, query_terms, query_ops, page_limit, progress, facet):
+        import tweepy
         # Are we resuming after an error
         if self.last_id:
-            print('Restarting with id={0}'.format(tg.last_id))
-            query_ops['max_id']=self.last_id
+            print('Restarting with id={0}'.format(self.last_id))
+            # max_id is inclusive, and we already have last_id
+            query_ops['max_id']=self.last_id - 1
         # max out tweets per page
         if 'count' not in query_ops:
             query_ops['count']=1000
         
         q = '(' + ' OR '.join(query_terms) + ')'
         
+        rate_limited = False
+        fetch_start = time.time()
         for page in tweepy.Cursor(self.api.search,
                                   q=urllib.quote_plus(q),
                                   **query_ops).pages(page_limit):
-            # Block/unblock signals between pages, to allow responsive ctrl-c
-            # while honoring syntactic boundaries
-            with suspended_signals(SIGINT):
-                for tweet in page:
-                    facet.emit(tweet._json)
-                    if 'id' in tweet._json:
-                        last_id = tweet._json['id']
-                        last_date = tweet.created_at.date()
-                    progress.next(tweet)
+            # with the rate limit used up, tweepy sleeps before fetching
+            if rate_limited:
+                RATE_LIMIT_SLEEP_SECONDS.observe(time.time() - fetch_start)
+            else:
+                API_PAGE_SECONDS.observe(time.time() - fetch_start)
+            TWEETS_FETCHED.inc(len(page))
+            self._emit_page(page, progress, facet)
+            rate_limited = self._rate_limit_remaining() == 0
+            fetch_start = time.time()
+    def _emit_page(self, page, progress, facet):
+        # Block/unblock signals between pages, to allow responsive ctrl-c
+        # while honoring syntactic boundaries
+        with suspended_signals(SIGINT):
+            for tweet in page:
+                facet.emit(tweet._json)
+                if 'id' in tweet._json:
+                    self.last_id = tweet._json['id']
+                progress.next(tweet)
+    def replay(self, pages, facet=None, progress=None):
+        """Emit `pages` of recorded statuses to `facet` (default: the
+        collector's facet), as if they had been returned by a search.
+        This exercises the collection path offline, eg for benchmarks.
+
+        """
+        facet = facet or self.facet
+        progress = progress or _NullProgress()
+        for page in pages:
+            self._emit_page(page, progress, facet)
+    def _rate_limit_remaining(self):
+        """Return the calls left in the current rate limit window, as
+        reported with the last API response, or None if unknown.
+
+        """
+        response = getattr(self.api, 'last_response', None)
+        if response is None:
+            return None
+        try:
+            return int(response.headers['x-rate-limit-remaining'])
+        except (KeyError, ValueError, AttributeError):
+            return None
     def _stream(self, query_terms, query_ops, page_limit, progress, facet):
+        import tweepy
+        from listeners import EmittingListener
         # cb for listener to tell when it's finished
         if 'until' in query_ops:
             def finished(status):
@@ -0,0 +1,102 @@
+from __future__ import print_function
+import unittest
+
+import os.path
+import threading
+
+from credentials import Credentials
+
+# Default options for new MongoClients; each client keeps a pool of up to
+# maxPoolSize sockets per server, shared by every thread and sink using it.
+MONGO_OPTIONS = {'maxPoolSize': 50,
+                 'minPoolSize': 0}
+
+# boto and pymongo are imported when a connection is first asked for, so
+# that processes using only one of them don't pay to load the other
+_lock = threading.Lock()
+_mongo_clients = {}
+_s3_connections = {}
+
+def _registry_key(*args, **options):
+    return args + tuple(sorted(options.items()))
+
+def mongo_client(uri=None, **options):
+    """Return the shared `MongoClient` for `uri` (default: the local
+    server) and `options`, creating it on first use.  Options not given
+    default to those in `MONGO_OPTIONS`.
+
+    """
+    import pymongo
+    merged = dict(MONGO_OPTIONS)
+    merged.update(options)
+    key = _registry_key(uri, **merged)
+    with _lock:
+        if key not in _mongo_clients:
+            _mongo_clients[key] = pymongo.MongoClient(uri, **merged)
+        return _mongo_clients[key]
+
+def s3_connection(access_key_id=None, secret_access_key=None, **options):
+    """Return the shared `S3Connection` for the given credentials and
+    options, creating it on first use.
+
+    """
+    from boto.s3.connection import S3Connection
+    key = _registry_key(access_key_id, secret_access_key, **options)
+    with _lock:
+        if key not in _s3_connections:
+            _s3_connections[key] = S3Connection(
+                access_key_id, secret_access_key, **options)
+        return _s3_connections[key]
+
+def aws_s3_connection(filename='~/.aws/credentials', **options):
+    """Return the shared `S3Connection` for the default credentials in
+    AWS credentials file `filename`.
+
+    """
+    creds = Credentials(os.path.expanduser(filename))
+    return s3_connection(creds.default_aws_access_key_id,
+                         creds.default_aws_secret_access_key,
+                         **options)
+
+def close_all():
+    """Close and forget every shared connection"""
+    with _lock:
+        for client in _mongo_clients.values():
+            client.close()
+        for conn in _s3_connections.values():
+            conn.close()
+        _mongo_clients.clear()
+        _s3_connections.clear()
+
+class ConnectionsTest(unittest.TestCase):
+    def test_mongo_client(self):
+        client = mongo_client()
+        self.assertTrue(mongo_client() is client)
+        self.assertTrue(mongo_client(None, **MONGO_OPTIONS) is client)
+        other = mongo_client(maxPoolSize=10)
+        self.assertFalse(other is client)
+        self.assertTrue(mongo_client(maxPoolSize=10) is other)
+        self.assertFalse(mongo_client('mongodb://localhost:27018') is client)
+
+    def test_s3_connection(self):
+        conn = s3_connection('key', 'secret')
+        self.assertTrue(s3_connection('key', 'secret') is conn)
+        self.assertFalse(s3_connection('other', 'secret') is conn)
+        self.assertFalse(s3_connection('key', 'secret', is_secure=False)
+                         is conn)
+
+    def test_close_all(self):
+        client = mongo_client()
+        conn = s3_connection('key', 'secret')
+        close_all()
+        self.assertEqual((_mongo_clients, _s3_connections), ({}, {}))
+        self.assertFalse(mongo_client() is client)
+        self.assertFalse(s3_connection('key', 'secret') is conn)
+
+    def tearDown(self):
+        close_all()
+
+def main():
+    unittest.main()
+if __name__ == '__main__':
+    main()
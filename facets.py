@@ -1,5 +1,73 @@
 from __future__ import print_function
+import unittest
+
+from collections import OrderedDict
+import datetime
 import json
+import time
+
+from metrics import REGISTRY
+from sketches import RotatingBloomFilter, SpaceSaving
+
+TWEETS_MATCHED = REGISTRY.counter(
+    'tweets_matched_total', 'Tweets matched by a FilteringFacet')
+TWEETS_DROPPED = REGISTRY.counter(
+    'tweets_duplicate_total', 'Duplicate tweets dropped by a DedupFacet')
+
+# Fields used by the analyses in proc.py and by the other facets
+TWEET_FIELDS = ['id',
+                'created_at',
+                'text',
+                'lang',
+                'user.id',
+                'user.screen_name',
+                'user.location',
+                'user.followers_count',
+                'retweeted_status.id',
+                'retweeted_status.text',
+                'retweeted_status.user.id',
+                'retweeted_status.user.screen_name',
+                'retweeted_status.user.location',
+                'retweeted_status.user.followers_count',
+                'entities.hashtags.text',
+                'entities.user_mentions.id']
+
+def _path_tree(paths):
+    """Turn dotted `paths` into a nested dict, with True at the leaves"""
+    tree = {}
+    for path in paths:
+        node = tree
+        fields = path.split('.')
+        for field in fields[:-1]:
+            child = node.setdefault(field, {})
+            if child is True:
+                break
+            node = child
+        else:
+            node[fields[-1]] = True
+    return tree
+
+def _project(value, tree):
+    if tree is True:
+        return value
+    if isinstance(value, list):
+        return [_project(item, tree) for item in value
+                if isinstance(item, dict)]
+    out = {}
+    for (field, subtree) in tree.items():
+        if field in value:
+            child = value[field]
+            if subtree is True or isinstance(child, (dict, list)):
+                out[field] = _project(child, subtree)
+    return out
+
+def project(doc, paths):
+    """Return a copy of `doc` with only the fields named by the dotted
+    `paths`.  As in MongoDB projections, a path through an array applies
+    to each of its elements.
+
+    """
+    return _project(doc, _path_tree(paths))
 
 class Facet(object):
     def emit(self, tweet):
@@ -12,6 +80,7 @@ class Facet(object):
 class FilteringFacet(Facet):
     def __init__(self, matcher, make_sink):
         self.sinks = {}
+        self.writes = {}
         self.matcher = matcher
         self.make_sink = make_sink
     def emit(self, tweet):
@@ -22,9 +91,14 @@ class FilteringFacet(Facet):
                 print("Making sink for key: {0}".format(key))
                 sink = self.make_sink(key)
                 self.sinks[key] = sink
+                self.writes[key] = REGISTRY.counter(
+                    'facet_writes_total', 'Tweets written, per facet key',
+                    key=key)
             else:
                 sink = self.sinks[key]                
             sink.write(json.dumps(tweet))
+            TWEETS_MATCHED.inc()
+            self.writes[key].inc()
             return True
         return False
     def close(self):
@@ -33,3 +107,255 @@ class FilteringFacet(Facet):
             sink.close()
         self.sinks = {}
 
+
+class HeavyHittersFacet(Facet):
+    """Facet that tracks the most frequent retweeted statuses, hashtags
+    and users in the tweets emitted to it, using a bounded-memory
+    `SpaceSaving` summary for each, and periodically writes a snapshot
+    of the top `k` of each to `sink` as a JSON record.  Tweets are
+    passed on to `facet`, if given.
+
+    """
+    def __init__(self, sink, facet=None, k=30, capacity=1000, interval=60):
+        """`capacity` is the number of counters per summary, and should be
+        well above `k`.  `interval` is the number of seconds between
+        snapshots; a final snapshot is written on close.
+
+        """
+        self.sink = sink
+        self.facet = facet
+        self.k = k
+        self.retweets = SpaceSaving(capacity)
+        self.hashtags = SpaceSaving(capacity)
+        self.users = SpaceSaving(capacity)
+        self.interval = interval
+        self.last_snapshot = time.time()
+    def emit(self, tweet):
+        rt = tweet.get('retweeted_status')
+        if rt and 'id' in rt:
+            self.retweets.offer(rt['id'])
+        for hashtag in tweet.get('entities', {}).get('hashtags', []):
+            self.hashtags.offer(hashtag['text'].lower())
+        user = tweet.get('user')
+        if user and 'id' in user:
+            self.users.offer(user['id'])
+        if time.time() - self.last_snapshot >= self.interval:
+            self.snapshot()
+        if self.facet:
+            return self.facet.emit(tweet)
+        return True
+    def snapshot(self):
+        """Write the current top `k` of each summary to the sink"""
+        self.last_snapshot = time.time()
+        self.sink.write(json.dumps({
+            'date': datetime.datetime.utcnow().isoformat(),
+            'retweets': self.retweets.top(self.k),
+            'hashtags': self.hashtags.top(self.k),
+            'users': self.users.top(self.k)}))
+        self.sink.flush()
+    def close(self):
+        self.snapshot()
+        self.sink.close()
+        if self.facet:
+            self.facet.close()
+
+class DedupFacet(Facet):
+    """Facet that drops tweets whose id it has (apparently) already seen,
+    before passing the rest on to `facet`.  Seen ids are kept in a
+    `RotatingBloomFilter` remembering at least the last `capacity`
+    distinct ids, in bounded memory; a false positive (at about
+    `error_rate`) drops a tweet that was not a duplicate.
+
+    """
+    def __init__(self, facet, capacity=1000000, error_rate=0.0001):
+        self.facet = facet
+        self.seen = RotatingBloomFilter(capacity, error_rate)
+        self.emitted = 0
+        self.dropped = 0
+    def emit(self, tweet):
+        if 'id' in tweet and not self.seen.add(tweet['id']):
+            self.dropped += 1
+            TWEETS_DROPPED.inc()
+            return False
+        self.emitted += 1
+        return self.facet.emit(tweet)
+    def stats(self):
+        """Return a dict of tweets passed and dropped, the estimated
+        false positive rate, and the memory used for seen ids.
+
+        """
+        return {'emitted': self.emitted,
+                'dropped': self.dropped,
+                'false_positive_rate': self.seen.false_positive_rate(),
+                'memory_bytes': self.seen.memory_bytes()}
+    def close(self):
+        print("Dedup: {emitted} tweets passed, {dropped} dropped, "
+              "false positive rate {false_positive_rate:.2g}, "
+              "{memory_bytes} bytes".format(**self.stats()))
+        self.facet.close()
+
+class _RecentIds(object):
+    """The last `capacity` distinct ids added, kept exactly"""
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.ids = OrderedDict()
+    def add(self, id):
+        """Add `id`, returning True if it was not already present"""
+        if id in self.ids:
+            # move it to the most recently used end
+            del self.ids[id]
+            self.ids[id] = True
+            return False
+        self.ids[id] = True
+        if len(self.ids) > self.capacity:
+            self.ids.popitem(last=False)
+        return True
+
+class ProjectingFacet(Facet):
+    """Facet that slims tweets down to the dotted `fields` (by default
+    `TWEET_FIELDS`) before passing them on to `facet`.  Keep any fields
+    that `facet` itself needs, eg `text` for a `FilteringFacet`.
+
+    If `user_sink` is given, the full user objects of each tweet (and of
+    the statuses it retweets or quotes) are written to it, as JSON, the
+    first time each user is seen, remembering the last `user_capacity`
+    users.  A user forgotten and seen again is written again, so use a
+    sink that deduplicates, eg a `MongoDBSink` with `key='id'`.
+
+    """
+    USER_PATHS = (('user',),
+                  ('retweeted_status', 'user'),
+                  ('quoted_status', 'user'))
+    def __init__(self, facet, fields=TWEET_FIELDS, user_sink=None,
+                 user_capacity=100000):
+        self.facet = facet
+        self.tree = _path_tree(fields)
+        self.user_sink = user_sink
+        self.users_seen = _RecentIds(user_capacity)
+    def emit(self, tweet):
+        if self.user_sink:
+            for path in self.USER_PATHS:
+                user = tweet
+                for field in path:
+                    user = user.get(field)
+                    if not isinstance(user, dict):
+                        break
+                else:
+                    if 'id' in user and self.users_seen.add(user['id']):
+                        self.user_sink.write(json.dumps(user))
+        return self.facet.emit(_project(tweet, self.tree))
+    def close(self):
+        if self.user_sink:
+            self.user_sink.close()
+        self.facet.close()
+
+class FacetTest(unittest.TestCase):
+    def test_project(self):
+        tweet = {'id': 1,
+                 'text': 'some text',
+                 'user': {'id': 2, 'screen_name': 'someone', 'bio': 'long'},
+                 'entities': {'hashtags': [{'text': 'a', 'indices': [0, 1]},
+                                           {'text': 'b', 'indices': [2, 3]}],
+                              'urls': []},
+                 'retweeted_status': None}
+        self.assertEqual(
+            project(tweet, ['id', 'user.id', 'entities.hashtags.text',
+                            'retweeted_status.id', 'missing']),
+            {'id': 1,
+             'user': {'id': 2},
+             'entities': {'hashtags': [{'text': 'a'}, {'text': 'b'}]}})
+        self.assertEqual(project(tweet, ['user', 'user.id'])['user'],
+                         tweet['user'])
+
+    def test_DedupFacet(self):
+        class CountingFacet(Facet):
+            emitted = 0
+            def emit(self, tweet):
+                self.emitted += 1
+                return True
+        facet = DedupFacet(CountingFacet(), capacity=100)
+        for i in list(range(50)) + list(range(25, 75)):
+            facet.emit({'id': i})
+        self.assertEqual(facet.facet.emitted, 75)
+        self.assertEqual(facet.stats()['dropped'], 25)
+
+    def test_ProjectingFacet(self):
+        class ListSink(object):
+            def __init__(self):
+                self.records = []
+            def write(self, string):
+                self.records.append(json.loads(string))
+            def close(self):
+                pass
+        class ListFacet(Facet):
+            def __init__(self):
+                self.tweets = []
+            def emit(self, tweet):
+                self.tweets.append(tweet)
+                return True
+            def close(self):
+                pass
+        users = ListSink()
+        facet = ProjectingFacet(ListFacet(), fields=['id', 'user.id'],
+                                user_sink=users, user_capacity=2)
+        def tweet(id, userid, rt_userid=None):
+            tweet = {'id': id, 'text': 'x',
+                     'user': {'id': userid, 'bio': 'long'}}
+            if rt_userid:
+                tweet['retweeted_status'] = {'id': 0, 'user': {'id': rt_userid}}
+            return tweet
+        for t in [tweet(1, 10), tweet(2, 10, 20), tweet(3, 20),
+                  tweet(4, 30), tweet(5, 30), tweet(6, 10)]:
+            facet.emit(t)
+        self.assertEqual(facet.facet.tweets[1], {'id': 2, 'user': {'id': 10}})
+        # 10 was forgotten once 20 and 30 were seen
+        self.assertEqual([user['id'] for user in users.records],
+                         [10, 20, 30, 10])
+        self.assertEqual(users.records[0]['bio'], 'long')
+
+    def test_HeavyHittersFacet(self):
+        class ListSink(object):
+            def __init__(self):
+                self.records = []
+                self.closed = False
+            def write(self, string):
+                self.records.append(json.loads(string))
+            def flush(self):
+                pass
+            def close(self):
+                self.closed = True
+        class ListFacet(Facet):
+            def __init__(self):
+                self.tweets = []
+            def emit(self, tweet):
+                self.tweets.append(tweet)
+                return True
+            def close(self):
+                pass
+        sink = ListSink()
+        facet = HeavyHittersFacet(sink, ListFacet(), k=2, capacity=10,
+                                  interval=3600)
+        tweets = [{'id': i,
+                   'user': {'id': i // 4},
+                   'entities': {'hashtags': [{'text': 'NBA'}] +
+                                [{'text': 'warriors'}] * (i % 2)},
+                   'retweeted_status': {'id': 100 + i % 2}}
+                  for i in range(7)]
+        for tweet in tweets:
+            self.assertTrue(facet.emit(tweet))
+        self.assertEqual(facet.facet.tweets, tweets)
+        self.assertEqual(sink.records, [])
+        facet.snapshot()
+        facet.close()
+        self.assertTrue(sink.closed)
+        self.assertEqual(len(sink.records), 2)
+        for snapshot in sink.records:
+            self.assertEqual(snapshot['retweets'], [[100, 4, 0], [101, 3, 0]])
+            self.assertEqual(snapshot['hashtags'],
+                             [['nba', 7, 0], ['warriors', 3, 0]])
+            self.assertEqual(snapshot['users'], [[0, 4, 0], [1, 3, 0]])
+
+def main():
+    unittest.main()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""In-memory stand-ins for the parts of boto's S3 API used by this
+package, so that S3 code can be tested and benchmarked without AWS.
+
+"""
+from io import BytesIO
+import threading
+
+class FakeKey(object):
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self._io = None
+    @property
+    def size(self):
+        return len(self.bucket.objects.get(self.name, b''))
+    def set_contents_from_string(self, data):
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        self.bucket.objects[self.name] = data
+    def set_contents_from_file(self, fp):
+        self.set_contents_from_string(fp.read())
+    def get_contents_as_string(self):
+        return self.bucket.objects[self.name]
+    def get_contents_to_file(self, fp):
+        fp.write(self.get_contents_as_string())
+    def read(self, size=-1):
+        if self._io is None:
+            self._io = BytesIO(self.get_contents_as_string())
+        return self._io.read(size)
+    def close(self):
+        self._io = None
+    def delete(self):
+        self.bucket.objects.pop(self.name, None)
+
+class FakeMultiPartUpload(object):
+    def __init__(self, bucket, key_name):
+        self.bucket = bucket
+        self.key_name = key_name
+        self.parts = {}
+        self._lock = threading.Lock()
+    def upload_part_from_file(self, fp, part_num):
+        data = fp.read()
+        with self._lock:
+            self.parts[part_num] = data
+    def complete_upload(self):
+        self.bucket.objects[self.key_name] = b''.join(
+            self.parts[n] for n in sorted(self.parts))
+    def cancel_upload(self):
+        self.parts = {}
+
+class FakeBucket(object):
+    def __init__(self, connection, name):
+        self.connection = connection
+        self.name = name
+        self.objects = {}
+    def new_key(self, name):
+        return FakeKey(self, name)
+    def get_key(self, name):
+        if name in self.objects:
+            return FakeKey(self, name)
+        return None
+    def delete_key(self, name):
+        self.objects.pop(name, None)
+    def list(self, prefix=''):
+        return [FakeKey(self, name) for name in sorted(self.objects)
+                if name.startswith(prefix)]
+    def initiate_multipart_upload(self, key_name):
+        return FakeMultiPartUpload(self, key_name)
+
+class FakeS3Connection(object):
+    def __init__(self, *args, **kwargs):
+        self.buckets = {}
+    def lookup(self, bucket_name):
+        return self.buckets.get(bucket_name)
+    def create_bucket(self, bucket_name):
+        return self.buckets.setdefault(bucket_name,
+                                       FakeBucket(self, bucket_name))
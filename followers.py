@@ -0,0 +1,357 @@
+from __future__ import print_function
+import unittest
+
+import datetime
+import heapq
+import time
+
+from bson.binary import Binary
+import pymongo
+
+from connections import mongo_client
+
+def encode_ids(ids, base=0):
+    """Encode an ascending sequence of non-negative integer ids as the
+    varint (LEB128) encoding of the gaps between consecutive ids,
+    starting from `base`.
+
+    """
+    out = bytearray()
+    prev = base
+    for i in ids:
+        delta = i - prev
+        if delta < 0:
+            raise ValueError("ids must be sorted: {0} after {1}".format(i, prev))
+        prev = i
+        while delta >= 0x80:
+            out.append((delta & 0x7f) | 0x80)
+            delta >>= 7
+        out.append(delta)
+    return bytes(out)
+
+def decode_ids(data, base=0):
+    """Yield the ids encoded in `data` by `encode_ids`"""
+    value = base
+    delta = 0
+    shift = 0
+    for byte in bytearray(data):
+        delta |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            value += delta
+            yield value
+            delta = 0
+            shift = 0
+
+def sorted_difference(a, b):
+    """Yield the items of ascending iterable `a` not in ascending iterable
+    `b`, reading each only once.
+
+    """
+    b = iter(b)
+    sentinel = object()
+    y = next(b, sentinel)
+    for x in a:
+        while y is not sentinel and y < x:
+            y = next(b, sentinel)
+        if y is sentinel or x != y:
+            yield x
+
+class FollowerStore(object):
+    """Stores follower id snapshots as sorted, delta/varint-encoded id
+    arrays, split across documents of at most `chunk_size` ids each
+    so that large follower lists stay well below the document size
+    limit.  Each chunk document looks like:
+
+        {'user': <user id>, 'tag': <snapshot tag>, 'seq': <chunk number>,
+         'first': <first id>, 'last': <last id>, 'count': <ids in chunk>,
+         'ids': <encoded ids>}
+
+    """
+    def __init__(self, coll, chunk_size=200000):
+        self.coll = coll
+        self.chunk_size = chunk_size
+        self.coll.create_index([('user', pymongo.ASCENDING),
+                                ('tag', pymongo.ASCENDING),
+                                ('seq', pymongo.ASCENDING)],
+                               unique=True)
+    def save(self, user, tag, ids):
+        """Replace the `tag` snapshot for `user` with the ids in iterable
+        `ids`, which need not be sorted or unique.  Returns the number
+        of distinct ids stored.
+
+        """
+        ids = sorted(set(ids))
+        self.delete(user, tag)
+        chunks = []
+        for (seq, start) in enumerate(range(0, len(ids), self.chunk_size)):
+            chunk = ids[start:start+self.chunk_size]
+            chunks.append({'user': user,
+                           'tag': tag,
+                           'seq': seq,
+                           'first': chunk[0],
+                           'last': chunk[-1],
+                           'count': len(chunk),
+                           'ids': Binary(encode_ids(chunk[1:], chunk[0]))})
+        if chunks:
+            self.coll.insert_many(chunks)
+        return len(ids)
+    def delete(self, user, tag):
+        """Remove the `tag` snapshot for `user`"""
+        self.coll.delete_many({'user': user, 'tag': tag})
+    def tags(self, user):
+        """Return the snapshot tags stored for `user`"""
+        return self.coll.distinct('tag', {'user': user})
+    def count(self, user, tag):
+        """Return the number of ids in the `tag` snapshot for `user`"""
+        total = 0
+        for chunk in self.coll.find({'user': user, 'tag': tag},
+                                    projection={'count': True}):
+            total += chunk['count']
+        return total
+    def iter_ids(self, user, tag):
+        """Yield the ids in the `tag` snapshot for `user` in ascending
+        order, one chunk in memory at a time.
+
+        """
+        for chunk in self.coll.find({'user': user, 'tag': tag},
+                                    sort=[('seq', pymongo.ASCENDING)]):
+            yield chunk['first']
+            for i in decode_ids(chunk['ids'], chunk['first']):
+                yield i
+    def diff(self, user, old_tag, new_tag):
+        """Return (lost, gained): iterators over the ids in the `old_tag`
+        snapshot but not the `new_tag` one, and vice versa.
+
+        """
+        lost = sorted_difference(self.iter_ids(user, old_tag),
+                                 self.iter_ids(user, new_tag))
+        gained = sorted_difference(self.iter_ids(user, new_tag),
+                                   self.iter_ids(user, old_tag))
+        return (lost, gained)
+
+class FollowerTracker(object):
+    """Takes periodic follower snapshots, storing only the ids added and
+    removed since the previous snapshot, plus a full checkpoint every
+    `checkpoint_every` snapshots so that any past snapshot can be
+    rebuilt from the nearest checkpoint and a few deltas.
+
+    Id arrays (deltas, checkpoints and the latest snapshot) are kept in
+    a `FollowerStore`; `snapshots` is a time-indexed collection with one
+    document per snapshot:
+
+        {'user': <user id>, 'seq': <snapshot number>, 'date': <datetime>,
+         'count': <followers>, 'added': <ids added>,
+         'removed': <ids removed>, 'checkpoint': <bool>}
+
+    A snapshot only exists once its document is inserted, after all of
+    its id arrays are stored, so a snapshot that fails part way is
+    simply retaken: its arrays are overwritten by the next attempt.
+
+    """
+    def __init__(self, store, snapshots, checkpoint_every=10):
+        self.store = store
+        self.snapshots = snapshots
+        self.checkpoint_every = checkpoint_every
+        self.snapshots.create_index([('user', pymongo.ASCENDING),
+                                     ('seq', pymongo.ASCENDING)],
+                                    unique=True)
+        self.snapshots.create_index([('user', pymongo.ASCENDING),
+                                     ('date', pymongo.ASCENDING)])
+    def record(self, user, ids, date=None):
+        """Record a snapshot of follower ids for `user` taken at `date`
+        (default now), returning its snapshot document.
+
+        """
+        if date is None:
+            date = datetime.datetime.utcnow()
+        ids = sorted(set(ids))
+        last = self.find_snapshot(user)
+        seq = 0
+        added = ids
+        removed = []
+        if last:
+            seq = last['seq'] + 1
+            # the previous snapshot as rebuilt from the stored deltas, so
+            # the new deltas are consistent with them
+            previous = list(self._rebuild(user, last))
+            added = list(sorted_difference(ids, previous))
+            removed = list(sorted_difference(previous, ids))
+            self.store.save(user, 'added:{0}'.format(seq), added)
+            self.store.save(user, 'removed:{0}'.format(seq), removed)
+        checkpoint = seq % self.checkpoint_every == 0
+        if checkpoint:
+            self.store.save(user, 'checkpoint:{0}'.format(seq), ids)
+        latest = 'latest:{0}'.format(seq)
+        self.store.save(user, latest, ids)
+        snapshot = {'user': user,
+                    'seq': seq,
+                    'date': date,
+                    'count': len(ids),
+                    'added': len(added),
+                    'removed': len(removed),
+                    'checkpoint': checkpoint}
+        self.snapshots.insert_one(snapshot)
+        # only now is the new full list the latest
+        for tag in self.store.tags(user):
+            if tag.startswith('latest') and tag != latest:
+                self.store.delete(user, tag)
+        return snapshot
+    def find_snapshot(self, user, date=None):
+        """Return the document for the last snapshot of `user` taken at or
+        before `date` (default: the latest), or None.
+
+        """
+        query = {'user': user}
+        if date is not None:
+            query['date'] = {'$lte': date}
+        return self.snapshots.find_one(query,
+                                       sort=[('date', pymongo.DESCENDING),
+                                             ('seq', pymongo.DESCENDING)])
+    def iter_ids(self, user, date=None):
+        """Return an iterator over the follower ids of `user`, in
+        ascending order, as of the last snapshot taken at or before
+        `date` (default: the latest).
+
+        """
+        snapshot = self.find_snapshot(user, date)
+        if snapshot is None:
+            return iter([])
+        if date is None:
+            return self.store.iter_ids(
+                user, 'latest:{0}'.format(snapshot['seq']))
+        return self._rebuild(user, snapshot)
+    def _rebuild(self, user, snapshot):
+        """Return an iterator over the ids of `snapshot`, rebuilt from the
+        nearest checkpoint and the deltas since.
+
+        """
+        checkpoint = self.snapshots.find_one(
+            {'user': user, 'checkpoint': True,
+             'seq': {'$lte': snapshot['seq']}},
+            sort=[('seq', pymongo.DESCENDING)])
+        ids = self.store.iter_ids(user,
+                                  'checkpoint:{0}'.format(checkpoint['seq']))
+        for seq in range(checkpoint['seq'] + 1, snapshot['seq'] + 1):
+            ids = heapq.merge(
+                sorted_difference(
+                    ids,
+                    self.store.iter_ids(user, 'removed:{0}'.format(seq))),
+                self.store.iter_ids(user, 'added:{0}'.format(seq)))
+        return ids
+    def diff(self, user, start, end):
+        """Return (lost, gained): iterators over the ids that stopped and
+        started following `user` between the snapshots in effect at
+        `start` and at `end`, each merging the two snapshots as they
+        are read.
+
+        """
+        lost = sorted_difference(self.iter_ids(user, start),
+                                 self.iter_ids(user, end))
+        gained = sorted_difference(self.iter_ids(user, end),
+                                   self.iter_ids(user, start))
+        return (lost, gained)
+    def run(self, users, fetch_ids, interval, rounds=None):
+        """Every `interval` seconds, snapshot the followers of each of
+        `users`, as returned by `fetch_ids(user)`, for `rounds` rounds
+        (default: forever).  A user whose fetch fails is skipped until
+        the next round.
+
+        """
+        done = 0
+        while rounds is None or done < rounds:
+            started = time.time()
+            for user in users:
+                try:
+                    snapshot = self.record(user, fetch_ids(user))
+                    print("User {0}: {1} followers, +{2} -{3}".format(
+                        user, snapshot['count'],
+                        snapshot['added'], snapshot['removed']))
+                except Exception as e:
+                    print("User {0}: {1}".format(user, e))
+            done += 1
+            if rounds is None or done < rounds:
+                time.sleep(max(0, interval - (time.time() - started)))
+
+class FollowersTest(unittest.TestCase):
+    def test_encoding(self):
+        ids = [0, 1, 127, 128, 300, 2**32, 2**62, 2**63 - 1]
+        self.assertEqual(list(decode_ids(encode_ids(ids))), ids)
+        self.assertEqual(list(decode_ids(encode_ids(ids[3:], 5), 5)), ids[3:])
+        self.assertEqual(encode_ids([1, 2, 3]), b'\x01\x01\x01')
+        self.assertRaises(ValueError, encode_ids, [2, 1])
+
+    def test_sorted_difference(self):
+        self.assertEqual(list(sorted_difference([1, 2, 4, 6], [2, 3, 6, 7])),
+                         [1, 4])
+        self.assertEqual(list(sorted_difference([1, 2], [])), [1, 2])
+        self.assertEqual(list(sorted_difference([], [1, 2])), [])
+
+    def test_FollowerStore(self):
+        store = FollowerStore(
+            mongo_client().test_db.test_followers, chunk_size=3)
+        self.assertEqual(store.save(1, 'initial', [9, 3, 5, 1, 7, 3]), 5)
+        store.save(1, 'final', [2, 3, 5, 7, 9, 11, 13])
+        self.assertEqual(list(store.iter_ids(1, 'initial')), [1, 3, 5, 7, 9])
+        self.assertEqual(store.count(1, 'final'), 7)
+        self.assertEqual(sorted(store.tags(1)), ['final', 'initial'])
+        (lost, gained) = store.diff(1, 'initial', 'final')
+        self.assertEqual(list(lost), [1])
+        self.assertEqual(list(gained), [2, 11, 13])
+
+    def test_FollowerTracker(self):
+        db = mongo_client().test_db
+        tracker = FollowerTracker(
+            FollowerStore(db.test_tracked_followers, chunk_size=2),
+            db.test_follower_snapshots,
+            checkpoint_every=2)
+        day = datetime.timedelta(1)
+        start = datetime.datetime(2015, 6, 1)
+        history = [[1, 2, 3], [2, 3, 4, 5], [3, 5, 6], [1, 3, 5, 6, 7]]
+        for (n, ids) in enumerate(history):
+            tracker.record(1, reversed(ids), start + n * day)
+        for (n, ids) in enumerate(history):
+            self.assertEqual(list(tracker.iter_ids(1, start + n * day)), ids)
+        self.assertEqual(list(tracker.iter_ids(1)), history[-1])
+        self.assertEqual(list(tracker.iter_ids(1, start - day)), [])
+        (lost, gained) = tracker.diff(1, start, start + 2 * day)
+        self.assertEqual((list(lost), list(gained)), ([1, 2], [5, 6]))
+        latest = tracker.find_snapshot(1)
+        self.assertEqual((latest['seq'], latest['added'], latest['removed']),
+                         (3, 2, 0))
+
+    def test_failed_record(self):
+        db = mongo_client().test_db
+        store = FollowerStore(db.test_tracked_followers_2)
+        tracker = FollowerTracker(store, db.test_follower_snapshots_2,
+                                  checkpoint_every=3)
+        day = datetime.timedelta(1)
+        start = datetime.datetime(2015, 6, 1)
+        tracker.record(1, [1, 2, 3], start)
+        # fail after the deltas are stored, before the snapshot is
+        save = store.save
+        def failing(user, tag, ids):
+            if tag.startswith('latest'):
+                raise IOError("injected")
+            return save(user, tag, ids)
+        store.save = failing
+        self.assertRaises(IOError, tracker.record, 1, [2, 3], start + day)
+        store.save = save
+        tracker.record(1, [3, 4], start + 2 * day)
+        tracker.record(1, [4, 5], start + 3 * day)
+        self.assertEqual(list(tracker.iter_ids(1, start + day)), [1, 2, 3])
+        self.assertEqual(list(tracker.iter_ids(1, start + 2 * day)), [3, 4])
+        self.assertEqual(list(tracker.iter_ids(1, start + 3 * day)), [4, 5])
+        self.assertEqual(list(tracker.iter_ids(1)), [4, 5])
+        self.assertEqual([tag for tag in store.tags(1)
+                          if tag.startswith('latest')], ['latest:2'])
+
+    @classmethod
+    def tearDownClass(cls):
+        mongo_client().drop_database('test_db')
+
+def main():
+    unittest.main()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+from __future__ import print_function
+import unittest
+
+import pymongo
+from pymongo import IndexModel
+
+from connections import mongo_client
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+def _index_keys(keys):
+    """Normalize `keys`, as accepted by `create_index`, to a list of
+    (field, direction) tuples.
+
+    """
+    if isinstance(keys, string_types):
+        return [(keys, pymongo.ASCENDING)]
+    return [tuple(k) for k in keys]
+
+def _signature(keys, weights=None):
+    """Return a comparable signature for an index on `keys`.  Text index
+    fields are compared as a set, since the server reports them in
+    `weights` rather than in the key.
+
+    """
+    plain = []
+    text = set(weights or ())
+    for (field, direction) in keys:
+        if field in ('_fts', '_ftsx'):
+            # the server reports a text index as these, with its fields
+            # in `weights`
+            continue
+        if direction == pymongo.TEXT:
+            text.add(field)
+        else:
+            plain.append((field, direction))
+    return (tuple(plain), frozenset(text))
+
+class IndexManager(object):
+    """Collects index specifications and builds them later, in one batch
+    per collection, skipping those that already exist.  This lets
+    indexes be requested wherever it is convenient (eg each time a
+    sink is closed) while the builds happen once, after bulk loads.
+
+    """
+    def __init__(self, background=True):
+        self.background = background
+        # (db name, collection name) -> (collection, {signature: IndexModel})
+        self.pending = {}
+    def ensure(self, coll, keys, **options):
+        """Request an index on `keys` for `coll`, with `create_index`
+        `options`.  Requesting the same index again is a no-op.
+
+        """
+        keys = _index_keys(keys)
+        if self.background and 'background' not in options:
+            options['background'] = True
+        (_, models) = self.pending.setdefault(
+            (coll.database.name, coll.name), (coll, {}))
+        models.setdefault(_signature(keys), IndexModel(keys, **options))
+    def exists(self, coll, keys):
+        """Indicate whether `coll` has an index on `keys`"""
+        return _signature(_index_keys(keys)) in self._existing(coll)
+    def _existing(self, coll):
+        return set(_signature(info['key'], info.get('weights'))
+                   for info in coll.index_information().values())
+    def build(self, coll=None):
+        """Create the pending indexes of `coll` (default: every
+        collection) that do not already exist, returning the names of
+        the indexes created.
+
+        """
+        if coll is None:
+            names = list(self.pending)
+        else:
+            names = [(coll.database.name, coll.name)]
+        created = []
+        for name in names:
+            if name not in self.pending:
+                continue
+            (coll, models) = self.pending.pop(name)
+            existing = self._existing(coll)
+            missing = [model for (signature, model) in models.items()
+                       if signature not in existing]
+            if missing:
+                print("Building {0} index(es) on {1}.{2}".format(
+                    len(missing), name[0], name[1]))
+                created.extend(coll.create_indexes(missing))
+        return created
+
+class IndexManagerTest(unittest.TestCase):
+    def test_IndexManager(self):
+        coll = mongo_client().test_db.test_indexes
+        coll.insert_one({'text': 'some text', 'user': {'id': 1}})
+        coll.create_index('user.id')
+        manager = IndexManager()
+        self.assertTrue(manager.exists(coll, 'user.id'))
+        self.assertFalse(manager.exists(coll, [('text', pymongo.TEXT)]))
+        for _ in range(3):
+            manager.ensure(coll, [('text', pymongo.TEXT)])
+        manager.ensure(coll, 'user.id')
+        manager.ensure(coll, [('user.id', pymongo.ASCENDING),
+                              ('text', pymongo.ASCENDING)])
+        self.assertEqual(len(manager.build()), 2)
+        self.assertTrue(manager.exists(coll, [('text', pymongo.TEXT)]))
+        manager.ensure(coll, [('text', pymongo.TEXT)])
+        manager.ensure(coll, 'user.id')
+        self.assertEqual(manager.build(), [])
+        self.assertEqual(manager.pending, {})
+
+    def test_signature(self):
+        # index_information() from a real server, for a text index
+        # requested as [('user.id', 1), ('text', 'text')]
+        info = {'key': [('user.id', 1), ('_fts', 'text'), ('_ftsx', 1)],
+                'weights': {'text': 1}, 'default_language': 'english',
+                'language_override': 'language', 'textIndexVersion': 3}
+        self.assertEqual(_signature(info['key'], info['weights']),
+                         _signature(_index_keys([('user.id', 1),
+                                                 ('text', pymongo.TEXT)])))
+        self.assertNotEqual(_signature(info['key'], info['weights']),
+                            _signature(_index_keys([('text', pymongo.TEXT)])))
+        class Collection(object):
+            name = 'tweets'
+            class database(object):
+                name = 'db'
+            def index_information(self):
+                return {'_id_': {'key': [('_id', 1)]},
+                        'user.id_1_text_text': info}
+            def create_indexes(self, models):
+                raise AssertionError("index already exists")
+        manager = IndexManager()
+        manager.ensure(Collection(), [('user.id', 1), ('text', pymongo.TEXT)])
+        self.assertEqual(manager.build(), [])
+
+    @classmethod
+    def tearDownClass(cls):
+        mongo_client().drop_database('test_db')
+
+def main():
+    unittest.main()
+if __name__ == '__main__':
+    main()
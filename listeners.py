@@ -5,6 +5,11 @@ from pysigset import suspended_signals
 
 import tweepy
 
+from metrics import REGISTRY
+
+TWEETS_FETCHED = REGISTRY.counter(
+    'tweets_fetched_total', 'Tweets received from the Twitter API')
+
 class EmittingListener(tweepy.StreamListener):
     def __init__(self, facet, progress, finished_fn, **kwargs):
         super(EmittingListener, self).__init__(**kwargs)
@@ -18,10 +23,11 @@ class EmittingListener(tweepy.StreamListener):
     def on_status(self, status):
         with suspended_signals(SIGINT):
             self.last_id = status.id
+            TWEETS_FETCHED.inc()
             self.facet.emit(status._json)
             self.progress.next(status)
             if self.finished_fn(status):
-                progress.finish()
+                self.progress.finish()
                 return False
     def on_error(self, code):
         if code in self.retry_errors:
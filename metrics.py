@@ -0,0 +1,291 @@
+from __future__ import print_function
+import unittest
+
+from bisect import bisect_left
+import threading
+import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+# Latency buckets, in seconds: 100us to ~15 minutes, doubling
+DEFAULT_BUCKETS = tuple(0.0001 * 2 ** i for i in range(24))
+
+def _label_string(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(k, v)
+                          for (k, v) in labels) + '}'
+
+class Counter(object):
+    """A count that only goes up.  Updates are not locked: under
+    concurrent use, an increment can (rarely) be lost.
+
+    """
+    kind = 'counter'
+    def __init__(self):
+        self.value = 0
+    def inc(self, n=1):
+        self.value += n
+    def samples(self, name, labels):
+        return [(name + _label_string(labels), self.value)]
+
+class Gauge(object):
+    """A value that can go up and down, or be read from `fn` on demand
+    (eg a queue length).
+
+    """
+    kind = 'gauge'
+    def __init__(self, fn=None):
+        self.value = 0
+        self.fn = fn
+    def set(self, value):
+        self.value = value
+    def get(self):
+        if self.fn:
+            return self.fn()
+        return self.value
+    def samples(self, name, labels):
+        return [(name + _label_string(labels), self.get())]
+
+class _Timer(object):
+    def __init__(self, histogram):
+        self.histogram = histogram
+    def __enter__(self):
+        self.start = time.time()
+        return self
+    def __exit__(self, x, y, z):
+        self.histogram.observe(time.time() - self.start)
+
+class Histogram(object):
+    """Counts observations (eg latencies, in seconds) in fixed buckets,
+    so recording is cheap and memory constant; quantiles are estimated
+    to within a bucket.
+
+    """
+    kind = 'histogram'
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+    def time(self):
+        """Return a context manager that observes the time spent in it"""
+        return _Timer(self)
+    def quantile(self, q):
+        """Estimate the `q` quantile as the upper bound of its bucket"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for (i, count) in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                if i < len(self.buckets):
+                    return self.buckets[i]
+                return float('inf')
+        return float('inf')
+    def samples(self, name, labels):
+        samples = []
+        cumulative = 0
+        for (bound, count) in zip(self.buckets + (float('inf'),),
+                                  self.counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            samples.append((name + '_bucket' +
+                            _label_string(labels + (('le', le),)),
+                            cumulative))
+        samples.append((name + '_sum' + _label_string(labels), self.sum))
+        samples.append((name + '_count' + _label_string(labels), self.count))
+        return samples
+
+class Registry(object):
+    """A set of named metrics, each optionally qualified by labels.
+    Asking for a metric that already exists returns it, so hot paths
+    should look their metrics up once and keep them.
+
+    """
+    def __init__(self):
+        self.metrics = {}
+        self.help = {}
+        self._lock = threading.Lock()
+    def _get(self, cls, name, help, labels, *args):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key not in self.metrics:
+                self.metrics[key] = cls(*args)
+                if help:
+                    self.help[name] = help
+            return self.metrics[key]
+    def counter(self, name, help='', **labels):
+        return self._get(Counter, name, help, labels)
+    def gauge(self, name, help='', fn=None, **labels):
+        gauge = self._get(Gauge, name, help, labels)
+        if fn:
+            gauge.fn = fn
+        return gauge
+    def histogram(self, name, help='', buckets=DEFAULT_BUCKETS, **labels):
+        return self._get(Histogram, name, help, labels, buckets)
+    def render(self):
+        """Return the metrics in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            items = sorted(self.metrics.items(), key=lambda x: x[0])
+        last_name = None
+        for ((name, labels), metric) in items:
+            if name != last_name:
+                if name in self.help:
+                    lines.append('# HELP {0} {1}'.format(name, self.help[name]))
+                lines.append('# TYPE {0} {1}'.format(name, metric.kind))
+                last_name = name
+            for (sample, value) in metric.samples(name, labels):
+                lines.append('{0} {1}'.format(sample, value))
+        return '\n'.join(lines) + '\n'
+    def summary(self):
+        """Return a one line summary of the metrics: counter and gauge
+        values, and histogram counts with p50 and p99.
+
+        """
+        parts = []
+        with self._lock:
+            items = sorted(self.metrics.items(), key=lambda x: x[0])
+        for ((name, labels), metric) in items:
+            label = name + _label_string(labels)
+            if isinstance(metric, Histogram):
+                if metric.count:
+                    parts.append('{0}=n:{1},p50:{2:.3g}s,p99:{3:.3g}s'.format(
+                        label, metric.count,
+                        metric.quantile(0.5), metric.quantile(0.99)))
+            elif isinstance(metric, Gauge):
+                parts.append('{0}={1}'.format(label, metric.get()))
+            else:
+                parts.append('{0}={1}'.format(label, metric.value))
+        return ' '.join(parts)
+
+# The registry used by the collector, facets and sinks
+REGISTRY = Registry()
+
+class LogReporter(object):
+    """Prints a summary of `registry` every `interval` seconds, from a
+    background thread, until stopped.
+
+    """
+    def __init__(self, registry=REGISTRY, interval=60):
+        self.registry = registry
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+    def start(self):
+        self._thread.start()
+        return self
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.report()
+            except Exception as e:
+                # a failing metric must not stop later reports
+                print("Metrics report failed:", e)
+    def report(self):
+        print("Metrics:", self.registry.summary())
+    def stop(self):
+        self._stop.set()
+        self.report()
+    def close(self):
+        self.stop()
+
+class PrometheusReporter(object):
+    """Serves `registry` in the Prometheus text format at
+    http://`host`:`port`/metrics, from a background thread.  Only local
+    clients can connect by default; pass host='' (all interfaces) to
+    let a remote Prometheus scrape it.
+
+    """
+    def __init__(self, registry=REGISTRY, port=9105, host='127.0.0.1'):
+        registry_ = registry
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry_.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, *args):
+                pass
+        self.server = HTTPServer((host, port), Handler)
+        self._thread = threading.Thread(target=self.server.serve_forever)
+        self._thread.daemon = True
+    def start(self):
+        self._thread.start()
+        return self
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+    def close(self):
+        self.stop()
+
+class MetricsTest(unittest.TestCase):
+    def test_Registry(self):
+        registry = Registry()
+        registry.counter('tweets_total', 'Tweets seen', sink='a').inc()
+        registry.counter('tweets_total', sink='a').inc(2)
+        registry.counter('tweets_total', sink='b').inc()
+        registry.gauge('depth', fn=lambda: 7)
+        latency = registry.histogram('latency_seconds', buckets=(0.1, 1))
+        for value in (0.05, 0.5, 0.5, 5):
+            latency.observe(value)
+        self.assertEqual(registry.counter('tweets_total', sink='a').value, 3)
+        self.assertEqual(latency.quantile(0.5), 1)
+        self.assertEqual(latency.quantile(0.25), 0.1)
+        self.assertEqual(latency.quantile(1), float('inf'))
+        text = registry.render()
+        for line in ['# HELP tweets_total Tweets seen',
+                     '# TYPE tweets_total counter',
+                     'tweets_total{sink="a"} 3',
+                     'tweets_total{sink="b"} 1',
+                     'depth 7',
+                     'latency_seconds_bucket{le="0.1"} 1',
+                     'latency_seconds_bucket{le="1"} 3',
+                     'latency_seconds_bucket{le="+Inf"} 4',
+                     'latency_seconds_count 4']:
+            self.assertTrue(line in text.split('\n'), line)
+        self.assertTrue('tweets_total{sink="a"}=3' in registry.summary())
+
+    def test_LogReporter(self):
+        registry = Registry()
+        calls = []
+        def flaky():
+            calls.append(None)
+            if len(calls) == 1:
+                raise OSError("gone")
+            return 1
+        registry.gauge('flaky', fn=flaky)
+        reporter = LogReporter(registry, interval=0.01).start()
+        deadline = time.time() + 5
+        while len(calls) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        reporter.stop()
+        self.assertTrue(len(calls) >= 2)
+
+    def test_timer(self):
+        latency = Histogram()
+        with latency.time():
+            time.sleep(0.01)
+        self.assertEqual(latency.count, 1)
+        self.assertTrue(latency.sum >= 0.01)
+
+def main():
+    unittest.main()
+if __name__ == '__main__':
+    main()
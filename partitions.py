@@ -0,0 +1,190 @@
+from __future__ import print_function
+import unittest
+
+import datetime
+
+from connections import mongo_client
+
+# The format of `created_at` in tweets and users from the Twitter API
+CREATED_AT_FORMAT = '%a %b %d %H:%M:%S +0000 %Y'
+
+PERIODS = ('day', 'week')
+
+def parse_created_at(created_at):
+    """Return the (UTC) datetime of a Twitter `created_at` string"""
+    return datetime.datetime.strptime(created_at, CREATED_AT_FORMAT)
+
+def _week_start(year, week):
+    """Return the Monday starting ISO week `week` of `year`"""
+    jan4 = datetime.date(year, 1, 4)
+    return (jan4 - datetime.timedelta(jan4.isoweekday() - 1) +
+            datetime.timedelta(weeks=week - 1))
+
+class Partitions(object):
+    """A set of collections in `db`, named `base` plus a suffix for the
+    `period` ('day' or 'week') of the tweets in each, so that tweets
+    for a date range can be read, and old tweets dropped, a whole
+    collection at a time.  Daily partitions are named like
+    tweets_20150617, and weekly ones (by ISO week) like tweets_2015w25.
+    Tweets without a `created_at` go to the `base` collection itself.
+
+    Date ranges are given as `start` (inclusive) and `end` (exclusive)
+    dates, either of which can be None for an open range.
+
+    """
+    def __init__(self, db, base, period='day'):
+        if period not in PERIODS:
+            raise ValueError("period must be one of {0}".format(PERIODS))
+        self.db = db
+        self.base = base
+        self.period = period
+        # created_at month, day and year -> partition name
+        self._names = {}
+    def name(self, date):
+        """Return the name of the partition holding tweets from `date`"""
+        if self.period == 'day':
+            return '{0}_{1:%Y%m%d}'.format(self.base, date)
+        (year, week, _) = date.isocalendar()
+        return '{0}_{1:04d}w{2:02d}'.format(self.base, year, week)
+    def route(self, tweet):
+        """Return the name of the partition for `tweet`"""
+        created_at = tweet.get('created_at')
+        if not created_at:
+            return self.base
+        # the partition only depends on the date, so parse each date once
+        key = created_at[4:10] + created_at[-4:]
+        name = self._names.get(key)
+        if name is None:
+            name = self.name(parse_created_at(created_at).date())
+            self._names[key] = name
+        return name
+    def span(self, name):
+        """Return the (start, end) dates of partition `name`, or None if
+        it is not a partition name.
+
+        """
+        prefix = self.base + '_'
+        if not name.startswith(prefix):
+            return None
+        suffix = name[len(prefix):]
+        try:
+            if self.period == 'day' and len(suffix) == 8:
+                start = datetime.datetime.strptime(suffix, '%Y%m%d').date()
+                return (start, start + datetime.timedelta(1))
+            if self.period == 'week' and len(suffix) == 7 and suffix[4] == 'w':
+                start = _week_start(int(suffix[:4]), int(suffix[5:]))
+                return (start, start + datetime.timedelta(7))
+        except ValueError:
+            pass
+        return None
+    def names(self, start=None, end=None):
+        """Return the names of the existing partitions with tweets from
+        dates in [`start`, `end`), oldest first.
+
+        """
+        spans = []
+        for name in self.db.collection_names():
+            span = self.span(name)
+            if span and ((start is None or span[1] > start) and
+                         (end is None or span[0] < end)):
+                spans.append((span, name))
+        return [name for (_, name) in sorted(spans)]
+    def collections(self, start=None, end=None):
+        """Return the partition collections for [`start`, `end`), oldest
+        first, eg to run an aggregation on each.
+
+        """
+        return [self.db[name] for name in self.names(start, end)]
+    def find(self, filter=None, start=None, end=None, **kwargs):
+        """Yield the tweets matching `filter` created in [`start`, `end`),
+        partition by partition, oldest first; `kwargs` are passed to
+        `find`.  Only partitions overlapping the range are read, and
+        only those partly outside it are filtered on `created_at`.
+
+        """
+        for name in self.names(start, end):
+            (first, last) = self.span(name)
+            partial = ((start is not None and first < start) or
+                       (end is not None and last > end))
+            for tweet in self.db[name].find(filter or {}, **kwargs):
+                if partial:
+                    date = parse_created_at(tweet['created_at']).date()
+                    if ((start is not None and date < start) or
+                            (end is not None and date >= end)):
+                        continue
+                yield tweet
+    def count(self, start=None, end=None):
+        """Return the number of tweets in the partitions overlapping
+        [`start`, `end`).
+
+        """
+        return sum(coll.count() for coll in self.collections(start, end))
+    def drop_before(self, date):
+        """Drop the partitions holding only tweets from before `date`,
+        returning their names.
+
+        """
+        dropped = []
+        for name in self.names(end=date):
+            if self.span(name)[1] <= date:
+                self.db.drop_collection(name)
+                dropped.append(name)
+        return dropped
+
+class PartitionsTest(unittest.TestCase):
+    def setUp(self):
+        self.db = mongo_client().test_db
+        self.days = Partitions(self.db, 'test_parts')
+        self.weeks = Partitions(self.db, 'test_parts', 'week')
+
+    def test_names(self):
+        tweet = {'created_at': 'Wed Jun 17 23:59:59 +0000 2015'}
+        self.assertEqual(self.days.route(tweet), 'test_parts_20150617')
+        self.assertEqual(self.weeks.route(tweet), 'test_parts_2015w25')
+        self.assertEqual(self.days.route({}), 'test_parts')
+        self.assertEqual(self.weeks.span('test_parts_2015w25'),
+                         (datetime.date(2015, 6, 15),
+                          datetime.date(2015, 6, 22)))
+        self.assertEqual(self.weeks.span('test_parts_2015w01'),
+                         (datetime.date(2014, 12, 29),
+                          datetime.date(2015, 1, 5)))
+        self.assertEqual(self.days.span('test_parts_2015w25'), None)
+        self.assertEqual(self.days.span('test_parts_counts'), None)
+
+    def test_range(self):
+        start = datetime.datetime(2015, 6, 10, 12)
+        for i in range(14):
+            created = start + datetime.timedelta(i)
+            tweet = {'id': i, 'created_at': created.strftime(CREATED_AT_FORMAT)}
+            for parts in (self.days, self.weeks):
+                self.db[parts.route(tweet)].insert_one(dict(tweet))
+        # June 10-23 spans weeks 24 (8-14), 25 (15-21) and 26 (22-28)
+        self.assertEqual(len(self.days.names()), 14)
+        self.assertEqual(self.weeks.names(),
+                         ['test_parts_2015w24', 'test_parts_2015w25',
+                          'test_parts_2015w26'])
+        (june15, june17) = (datetime.date(2015, 6, 15),
+                            datetime.date(2015, 6, 17))
+        self.assertEqual(self.days.names(june15, june17),
+                         ['test_parts_20150615', 'test_parts_20150616'])
+        self.assertEqual(self.weeks.names(june15, june17),
+                         ['test_parts_2015w25'])
+        for parts in (self.days, self.weeks):
+            self.assertEqual(sorted(t['id'] for t in
+                                    parts.find(start=june15, end=june17)),
+                             [5, 6])
+            self.assertEqual(len(list(parts.find({'id': {'$gt': 10}},
+                                                 start=june15))), 3)
+        self.assertEqual(self.weeks.count(june15, june17), 7)
+        self.assertEqual(self.weeks.drop_before(june17),
+                         ['test_parts_2015w24'])
+        self.assertEqual(len(self.days.drop_before(june17)), 7)
+        self.assertEqual(self.days.names()[0], 'test_parts_20150617')
+
+    def tearDown(self):
+        mongo_client().drop_database('test_db')
+
+def main():
+    unittest.main()
+if __name__ == '__main__':
+    main()
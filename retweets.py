@@ -0,0 +1,73 @@
+from __future__ import print_function
+
+import pymongo
+from pymongo import UpdateOne
+
+class RetweetCounter(object):
+    """Maintains a collection of retweet counts as tweets are ingested,
+    so that the top retweets can be read off an index on `count`
+    instead of aggregating over every tweet.  Each document matches
+    the output of the top retweets `$group` stage:
+
+        {'_id': <retweeted status id>, 'count': <retweets seen>,
+         'user': <retweeted status user>, 'text': <retweeted status text>}
+
+    Counts are accumulated in memory and applied with one bulk write
+    per `batch_size` retweets, and on `flush`.
+
+    """
+    def __init__(self, coll, batch_size=1000):
+        self.coll = coll
+        self.batch_size = batch_size
+        self.pending = {}
+        self.pending_count = 0
+        self.coll.create_index([('count', pymongo.DESCENDING)])
+    def add(self, tweet):
+        """Count `tweet` if it is a retweet"""
+        rt = tweet.get('retweeted_status')
+        if not rt or 'id' not in rt:
+            return
+        entry = self.pending.get(rt['id'])
+        if entry:
+            entry[0] += 1
+        else:
+            self.pending[rt['id']] = [1, rt.get('user'), rt.get('text')]
+        self.pending_count += 1
+        if self.pending_count >= self.batch_size:
+            self.flush()
+    def add_many(self, tweets):
+        """Count each retweet in `tweets`"""
+        for tweet in tweets:
+            self.add(tweet)
+    def flush(self):
+        """Apply the pending counts to the collection"""
+        if self.pending:
+            self.coll.bulk_write(
+                [UpdateOne({'_id': rt_id},
+                           {'$inc': {'count': count},
+                            '$setOnInsert': {'user': user, 'text': text}},
+                           upsert=True)
+                 for (rt_id, (count, user, text)) in self.pending.items()],
+                ordered=False)
+        self.pending = {}
+        self.pending_count = 0
+    def top(self, k):
+        """Return a cursor over the `k` most retweeted statuses"""
+        return self.coll.find({},
+                              sort=[('count', pymongo.DESCENDING)]).limit(k)
+    def rebuild(self, tweets):
+        """Recompute every count from the `tweets` collection, eg to
+        backfill tweets that were loaded without a counter.  The
+        counts collection must be in the same database as `tweets`.
+
+        """
+        self.pending = {}
+        self.pending_count = 0
+        tweets.aggregate([
+            {'$match': {'retweeted_status.id': {'$exists': True}}},
+            {'$group': {'_id': '$retweeted_status.id',
+                        'count': {'$sum': 1},
+                        'user': {'$first': '$retweeted_status.user'},
+                        'text': {'$first': '$retweeted_status.text'}}},
+            {'$out': self.coll.name}])
+        self.coll.create_index([('count', pymongo.DESCENDING)])
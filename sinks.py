@@ -7,9 +7,12 @@ import gc
 import os.path
 import os
 import json
+import time
 
-from boto.s3.key import Key
-import pymongo
+# pymongo is imported by the sinks that use it, and boto by the S3
+# connection, so each backend is only loaded when a sink needs it
+from connections import aws_s3_connection, mongo_client
+from metrics import REGISTRY
 
 class Sink(object):
     def open(self, filename):
@@ -18,6 +21,10 @@ class Sink(object):
     def write(self, string):
         """Send a record to the sink"""
         raise NotImplementedError
+    def write_many(self, strings):
+        """Send a batch of records to the sink"""
+        for string in strings:
+            self.write(string)
     def flush(self):
         """Request the sync commit data"""
         raise NotImplementedError
@@ -89,7 +96,7 @@ class S3Sink(Sink):
     def open(self, filename):
         if self.is_open:
             self.close()
-        self.key = Key(self.bucket, filename)
+        self.key = self.bucket.new_key(filename)
         self._io = BytesIO()
         self.is_open = True
     def write(self, string):
@@ -193,11 +200,25 @@ class RollingSink(Sink):
 
 
 class MongoDBSink(Sink):
-    def __init__(self, dbname):
-        self.dbclient = pymongo.MongoClient()
+    def __init__(self, dbname, indexes=None, dbclient=None, key=None,
+                 text_index=True):
+        """`indexes` is an `IndexManager` with which to request the text
+        index on close, leaving the caller to build it (eg once all
+        sinks are closed).  Without one, the index is built on close if
+        missing.  `dbclient` defaults to the shared client for the local
+        server, so sinks share one connection pool.
+        If `key` is given, each record is upserted with its `key` field
+        as `_id`, so that writing a record again replaces it.
+        `text_index` says whether to index the `text` field on close.
+
+        """
+        self.dbclient = dbclient or mongo_client()
         self.db = self.dbclient[dbname]
         self.coll = None
         self.is_open = False
+        self.indexes = indexes
+        self.key = key
+        self.text_index = text_index
     def open(self, collname):
         """Prepare a sink to receive data"""
         if not self.is_open:
@@ -206,29 +227,179 @@ class MongoDBSink(Sink):
     def write(self, string):
         """Send a record to the sink"""
         if self.is_open:
-            self.coll.insert_one(json.loads(string))
+            self._write(self.coll, json.loads(string))
+    def _write(self, coll, doc):
+        if self.key:
+            doc['_id'] = doc[self.key]
+            coll.replace_one({'_id': doc['_id']}, doc, upsert=True)
+        else:
+            coll.insert_one(doc)
+    def write_many(self, strings):
+        """Send a batch of records to the sink"""
+        if self.is_open and strings:
+            self._write_many(self.coll,
+                             [json.loads(string) for string in strings])
+    def _write_many(self, coll, docs):
+        if self.key:
+            from pymongo import ReplaceOne
+            for doc in docs:
+                doc['_id'] = doc[self.key]
+            coll.bulk_write(
+                [ReplaceOne({'_id': doc['_id']}, doc, upsert=True)
+                 for doc in docs])
+        else:
+            coll.insert_many(docs, ordered=False)
     def flush(self):
         """Request the sync commit data"""
         pass
     def close(self):
         """Indicate final record has been sent to the sink"""
+        if self.is_open and self.text_index:
+            self._index_text([self.coll])
         if self.is_open:
-            self.coll.create_index([('text',pymongo.TEXT)])
             self.coll = None
             self.is_open = False
+    def _index_text(self, colls):
+        import pymongo
+        from indexes import IndexManager
+        indexes = self.indexes or IndexManager()
+        for coll in colls:
+            indexes.ensure(coll, [('text',pymongo.TEXT)])
+        if not self.indexes:
+            indexes.build()
     def exists(self, collname):
         """Indicate the specified path exists, if True"""
         return collname in self.db.collection_names()
 
+class PartitionedMongoDBSink(MongoDBSink):
+    """This is a MongoDB sink that routes each record to a collection
+    for the day or week (`period`) in which it was created, named after
+    the collection passed to `open` (see `partitions.Partitions`), so
+    that date ranges can be read, and old records dropped, a collection
+    at a time.  Otherwise it behaves as `MongoDBSink`, with the text
+    index requested for each partition written.
+
+    """
+    def __init__(self, dbname, period='day', indexes=None, dbclient=None,
+                 key=None, text_index=True):
+        MongoDBSink.__init__(self, dbname, indexes, dbclient, key, text_index)
+        self.period = period
+        self.partitions = None
+        self.colls = {}
+    def open(self, collname):
+        """Prepare a sink to receive data"""
+        if not self.is_open:
+            from partitions import Partitions
+            self.partitions = Partitions(self.db, collname, self.period)
+            self.is_open = True
+    def _partition(self, doc):
+        name = self.partitions.route(doc)
+        coll = self.colls.get(name)
+        if coll is None:
+            coll = self.colls[name] = self.db[name]
+        return coll
+    def write(self, string):
+        """Send a record to the sink"""
+        if self.is_open:
+            doc = json.loads(string)
+            self._write(self._partition(doc), doc)
+    def write_many(self, strings):
+        """Send a batch of records to the sink"""
+        if self.is_open and strings:
+            batches = {}
+            for string in strings:
+                doc = json.loads(string)
+                batches.setdefault(self._partition(doc).name, []).append(doc)
+            for (name, docs) in batches.items():
+                self._write_many(self.colls[name], docs)
+    def close(self):
+        """Indicate final record has been sent to the sink"""
+        if self.is_open and self.text_index:
+            self._index_text(self.colls.values())
+        if self.is_open:
+            self.partitions = None
+            self.colls = {}
+            self.is_open = False
+    def exists(self, collname):
+        """Indicate the specified path exists, if True"""
+        from partitions import Partitions
+        return (MongoDBSink.exists(self, collname) or
+                bool(Partitions(self.db, collname, self.period).names()))
+
+class RetweetCountSink(Sink):
+    """This is a sink that passes records through to another sink, while
+    counting the retweets among them with a `RetweetCounter`.
+
+    """
+    def __init__(self, counter, sink):
+        self.is_open = False
+        self.counter = counter
+        self.sink = sink
+    def open(self, *args):
+        self.sink.open(*args)
+        self.is_open = True
+    def write(self, string):
+        self.sink.write(string)
+        self.counter.add(json.loads(string))
+    def write_many(self, strings):
+        self.sink.write_many(strings)
+        for string in strings:
+            self.counter.add(json.loads(string))
+    def flush(self):
+        self.sink.flush()
+        self.counter.flush()
+    def close(self):
+        self.counter.flush()
+        if self.is_open:
+            self.sink.close()
+            self.is_open = False
+    def exists(self, path):
+        return self.sink.exists(path)
+
+class InstrumentedSink(Sink):
+    """This is a sink that passes records through to another sink,
+    counting records written and timing writes, flushes and closes,
+    labelled with `name`.
+
+    """
+    def __init__(self, name, sink, registry=REGISTRY):
+        self.is_open = False
+        self.sink = sink
+        self.writes = registry.counter(
+            'sink_writes_total', 'Records written to a sink', sink=name)
+        self.write_seconds = registry.histogram(
+            'sink_write_seconds', 'Time to write records to a sink', sink=name)
+        self.flush_seconds = registry.histogram(
+            'sink_flush_seconds', 'Time to flush a sink', sink=name)
+        self.close_seconds = registry.histogram(
+            'sink_close_seconds', 'Time to close a sink', sink=name)
+    def open(self, *args):
+        self.sink.open(*args)
+        self.is_open = True
+    def write(self, string):
+        start = time.time()
+        self.sink.write(string)
+        self.write_seconds.observe(time.time() - start)
+        self.writes.inc()
+    def write_many(self, strings):
+        start = time.time()
+        self.sink.write_many(strings)
+        self.write_seconds.observe(time.time() - start)
+        self.writes.inc(len(strings))
+    def flush(self):
+        with self.flush_seconds.time():
+            self.sink.flush()
+    def close(self):
+        with self.close_seconds.time():
+            self.sink.close()
+        self.is_open = False
+    def exists(self, path):
+        return self.sink.exists(path)
+
 class SinkTest(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
-        from boto.s3.connection import S3Connection
-        from credentials import Credentials
-        cls.creds = Credentials(os.path.expanduser('~/.aws/credentials'))
-        cls.conn = S3Connection(
-            cls.creds.default_aws_access_key_id,
-            cls.creds.default_aws_secret_access_key)
+        cls.conn = aws_s3_connection()
 
     def check(self, f, exp):
         act = f.readline()
@@ -283,11 +454,11 @@ class SinkTest(unittest.TestCase):
             f.write('"Record 3"')
             f.write('"Record 4"')
         b = SinkTest.conn.lookup('nkrishna-mids205')
-        k = Key(b, '/foo/bar/0')
+        k = b.new_key('/foo/bar/0')
         f = BytesIO()
         k.get_contents_to_file(f)
         self.assertEqual(f.getvalue(), '[\n"Record 1",\n"Record 2"\n]\n')
-        k = Key(b, '/foo/bar/1')
+        k = b.new_key('/foo/bar/1')
         f = BytesIO()
         k.get_contents_to_file(f)
         self.assertEqual(f.getvalue(), '[\n"Record 3",\n"Record 4"\n]\n')
@@ -316,14 +487,77 @@ class SinkTest(unittest.TestCase):
         os.removedirs('./foo/bar')
         
         b = SinkTest.conn.lookup('nkrishna-mids205')
-        k = Key(b, '/foo/bar/0')
+        k = b.new_key('/foo/bar/0')
         k.delete()
-        k = Key(b, '/foo/bar/1')
+        k = b.new_key('/foo/bar/1')
         k.delete()
         
-        dbclient = pymongo.MongoClient()
+        dbclient = mongo_client()
         dbclient.drop_database('test_db')
 
+# Tests needing only a MongoDB server; SinkTest also needs AWS credentials
+class MongoDBSinkTest(unittest.TestCase):
+    def test_key(self):
+        with closing(MongoDBSink('test_db', key='id',
+                                 text_index=False)) as f:
+            f.open('test_users')
+            f.write(json.dumps({'id': 1, 'name': 'old'}))
+            f.write_many([json.dumps({'id': 2, 'name': 'b'}),
+                          json.dumps({'id': 1, 'name': 'new'})])
+            f.write(json.dumps({'id': 2, 'name': 'c'}))
+        coll = mongo_client().test_db.test_users
+        self.assertEqual(sorted((doc['_id'], doc['name'])
+                                for doc in coll.find()),
+                         [(1, 'new'), (2, 'c')])
+
+    def test_RetweetCountSink(self):
+        from retweets import RetweetCounter
+        db = mongo_client().test_db
+        counter = RetweetCounter(db.test_rt_counts, batch_size=2)
+        tweets = [{'text': 'a', 'retweeted_status': {'id': 1, 'text': 'x',
+                                                     'user': {'id': 10}}},
+                  {'text': 'b'},
+                  {'text': 'c', 'retweeted_status': {'id': 2, 'text': 'y',
+                                                     'user': {'id': 20}}},
+                  {'text': 'd', 'retweeted_status': {'id': 1, 'text': 'x',
+                                                     'user': {'id': 10}}}]
+        with closing(RetweetCountSink(counter,
+                                      MongoDBSink('test_db'))) as f:
+            f.open('test_rt_tweets')
+            for tweet in tweets:
+                f.write(json.dumps(tweet))
+        self.assertEqual([(row['_id'], row['count'], row['text'])
+                          for row in counter.top(30)],
+                         [(1, 2, 'x'), (2, 1, 'y')])
+        counter.rebuild(db.test_rt_tweets)
+        self.assertEqual([(row['_id'], row['count'], row['user']['id'])
+                          for row in counter.top(1)],
+                         [(1, 2, 10)])
+
+    def test_PartitionedMongoDBSink(self):
+        tweets = [{'id': 1, 'text': 'a',
+                   'created_at': 'Wed Jun 17 00:00:01 +0000 2015'},
+                  {'id': 2, 'text': 'b',
+                   'created_at': 'Thu Jun 18 00:00:01 +0000 2015'},
+                  {'id': 3, 'text': 'c',
+                   'created_at': 'Wed Jun 17 12:00:00 +0000 2015'}]
+        with closing(PartitionedMongoDBSink('test_db')) as f:
+            f.open('test_parts')
+            f.write(json.dumps(tweets[0]))
+            f.write_many([json.dumps(tweet) for tweet in tweets[1:]])
+        self.assertTrue(f.exists('test_parts'))
+        self.assertFalse(f.exists('fake_parts'))
+        db = mongo_client().test_db
+        self.assertEqual(sorted(doc['id'] for doc in
+                                db.test_parts_20150617.find()), [1, 3])
+        self.assertEqual([doc['id'] for doc in
+                          db.test_parts_20150618.find()], [2])
+        self.assertEqual(len(db.test_parts_20150618.index_information()), 2)
+
+    @classmethod
+    def tearDownClass(cls):
+        mongo_client().drop_database('test_db')
+
 def main():
     unittest.main()
 if __name__ == '__main__':
@@ -0,0 +1,190 @@
+from __future__ import print_function
+import unittest
+
+import hashlib
+import heapq
+import math
+import struct
+
+class SpaceSaving(object):
+    """Space-Saving heavy hitters summary (Metwally et al, 2005), which
+    tracks approximate counts of the most frequent items in a stream
+    using at most `capacity` counters.  When a new item arrives and
+    all counters are in use, it replaces the item with the smallest
+    count, inheriting that count as its possible overestimate
+    (`error`).  Any item occurring more than N/`capacity` times in a
+    stream of N items is guaranteed to be tracked.
+
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        self.total = 0
+        # min-heap of (count, item); entries go stale as counts change,
+        # and are skipped (or compacted away) rather than updated
+        self._heap = []
+    def offer(self, item, n=1):
+        """Count `n` occurrences of `item`"""
+        self.total += n
+        if item in self.counts:
+            self.counts[item] += n
+        elif len(self.counts) < self.capacity:
+            self.counts[item] = n
+            self.errors[item] = 0
+        else:
+            (count, victim) = self._pop_min()
+            del self.counts[victim]
+            del self.errors[victim]
+            self.counts[item] = count + n
+            self.errors[item] = count
+        heapq.heappush(self._heap, (self.counts[item], item))
+        if len(self._heap) > 4 * self.capacity:
+            self._heap = [(n, x) for (x, n) in self.counts.items()]
+            heapq.heapify(self._heap)
+    def _pop_min(self):
+        while True:
+            (count, item) = heapq.heappop(self._heap)
+            if self.counts.get(item) == count:
+                return (count, item)
+    def top(self, k):
+        """Return the `k` items with the highest counts, as a list of
+        (item, count, error) tuples in descending order of count.  An
+        item's true count is between count-error and count.
+
+        """
+        return [(item, count, self.errors[item])
+                for (item, count) in heapq.nlargest(
+                        k, self.counts.items(), key=lambda x: x[1])]
+    def __len__(self):
+        return len(self.counts)
+
+class BloomFilter(object):
+    """Bloom filter sized to hold `capacity` items with a false positive
+    rate of about `error_rate`.
+
+    """
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = capacity
+        self.bits = int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(
+            float(self.bits) / capacity * math.log(2))))
+        self.array = bytearray((self.bits + 7) // 8)
+        self.count = 0
+    def _positions(self, item):
+        # double hashing (Kirsch & Mitzenmacher) on one md5 digest
+        digest = hashlib.md5(repr(item).encode('utf-8')).digest()
+        (h1, h2) = struct.unpack('<QQ', digest)
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+    def add(self, item):
+        """Add `item`, returning True if it was not (apparently) present"""
+        new = False
+        for pos in self._positions(item):
+            mask = 1 << (pos & 7)
+            if not self.array[pos >> 3] & mask:
+                self.array[pos >> 3] |= mask
+                new = True
+        if new:
+            self.count += 1
+        return new
+    def __contains__(self, item):
+        return all(self.array[pos >> 3] & (1 << (pos & 7))
+                   for pos in self._positions(item))
+    def false_positive_rate(self):
+        """Estimate the current false positive rate"""
+        return (1 - math.exp(
+            -float(self.hashes) * self.count / self.bits)) ** self.hashes
+    def memory_bytes(self):
+        return len(self.array)
+
+class RotatingBloomFilter(object):
+    """Remembers about the last `capacity` * `generations` distinct items
+    in bounded memory, using `generations` Bloom filters of `capacity`
+    items each.  Items are added to the newest filter; when it is full,
+    the oldest filter is discarded and a new one started.  Membership
+    is checked against every filter, so an item is remembered for at
+    least `capacity` * (`generations` - 1) further distinct items.
+
+    """
+    def __init__(self, capacity, error_rate=0.001, generations=2):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.generations = generations
+        self.filters = [BloomFilter(capacity, error_rate)]
+    def add(self, item):
+        """Add `item`, returning True if it was not (apparently) seen"""
+        if any(item in f for f in self.filters[:-1]):
+            return False
+        if not self.filters[-1].add(item):
+            return False
+        if self.filters[-1].count >= self.capacity:
+            self.filters.append(BloomFilter(self.capacity, self.error_rate))
+            self.filters = self.filters[-self.generations:]
+        return True
+    def __contains__(self, item):
+        return any(item in f for f in self.filters)
+    def false_positive_rate(self):
+        """Estimate the current false positive rate"""
+        p = 1.0
+        for f in self.filters:
+            p *= 1 - f.false_positive_rate()
+        return 1 - p
+    def memory_bytes(self):
+        return sum(f.memory_bytes() for f in self.filters)
+
+class SketchesTest(unittest.TestCase):
+    def test_SpaceSaving(self):
+        ss = SpaceSaving(4)
+        stream = 'aaaaabbbbccd' + 'ee' + 'a'
+        for item in stream:
+            ss.offer(item)
+        self.assertEqual(len(ss), 4)
+        self.assertEqual(ss.total, len(stream))
+        top = ss.top(2)
+        self.assertEqual([item for (item, count, error) in top], ['a', 'b'])
+        self.assertEqual(top[0][1:], (6, 0))
+        self.assertEqual(ss.top(4)[2], ('e', 3, 1))
+        for (item, count, error) in ss.top(4):
+            self.assertTrue(count - error <= stream.count(item) <= count)
+
+    def test_SpaceSaving_bounded(self):
+        ss = SpaceSaving(10)
+        for i in range(10000):
+            ss.offer(i % 3 if i % 4 else -i)
+        self.assertEqual(len(ss), 10)
+        self.assertTrue(len(ss._heap) <= 40)
+        self.assertEqual(sorted(item for (item, count, error) in ss.top(3)),
+                         [0, 1, 2])
+
+    def test_BloomFilter(self):
+        bf = BloomFilter(1000, 0.01)
+        self.assertTrue(bf.add(1))
+        self.assertFalse(bf.add(1))
+        self.assertTrue(1 in bf)
+        for i in range(2, 1001):
+            bf.add(i)
+        false_positives = sum(1 for i in range(1001, 11001) if i in bf)
+        self.assertTrue(false_positives < 300)
+        self.assertTrue(0.005 < bf.false_positive_rate() < 0.02)
+
+    def test_RotatingBloomFilter(self):
+        rbf = RotatingBloomFilter(100, generations=3)
+        memory = None
+        added = 0
+        for i in range(1000):
+            added += rbf.add(i)
+            self.assertFalse(rbf.add(i))
+            if i == 300:
+                memory = rbf.memory_bytes()
+        # allowing for a few false positives
+        self.assertTrue(added > 990)
+        self.assertEqual(rbf.memory_bytes(), memory)
+        self.assertTrue(all(i in rbf for i in range(800, 1000)))
+        self.assertTrue(sum(1 for i in range(500) if i in rbf) < 10)
+        self.assertTrue(rbf.false_positive_rate() < 0.01)
+
+def main():
+    unittest.main()
+if __name__ == '__main__':
+    main()
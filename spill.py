@@ -0,0 +1,454 @@
+from __future__ import print_function
+import unittest
+
+import os
+import os.path
+import shutil
+import struct
+import tempfile
+import threading
+import time
+
+from metrics import REGISTRY
+from sinks import Sink
+
+_RECORD_HEADER = struct.Struct('>I')
+
+class SpillLog(object):
+    """An append-only log of string records, stored in a directory as a
+    sequence of segment files of about `segment_bytes` each.  Each
+    record is written as a 4 byte length followed by its UTF-8 bytes.
+    Appends are fsynced in batches, every `fsync_every` records or
+    `fsync_interval` seconds, whichever comes first; a crash can lose
+    at most that batch, and a record cut short by one is skipped when
+    reading.
+
+    Segments are "sealed" once full (or on request), after which they
+    can be read and removed.  Segments left in the directory by an
+    earlier process are picked up as sealed segments.
+
+    """
+    def __init__(self, directory, segment_bytes=64*1024*1024,
+                 fsync_every=1000, fsync_interval=1.0):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.segments = sorted(
+            os.path.join(directory, name) for name in os.listdir(directory)
+            if name.startswith('spill.') and name.endswith('.log'))
+        self.next_segment = 0
+        if self.segments:
+            self.next_segment = int(self.segments[-1].split('.')[-2]) + 1
+        self.file = None
+        self.path = None
+        self.unsynced = 0
+        self.last_sync = time.time()
+    def append(self, string):
+        """Append `string` to the current segment"""
+        if not isinstance(string, bytes):
+            string = string.encode('utf-8')
+        if self.file is None:
+            self.path = os.path.join(
+                self.directory, 'spill.{0:08d}.log'.format(self.next_segment))
+            self.next_segment += 1
+            self.file = open(self.path, 'ab')
+        self.file.write(_RECORD_HEADER.pack(len(string)))
+        self.file.write(string)
+        self.unsynced += 1
+        if (self.unsynced >= self.fsync_every or
+                time.time() - self.last_sync >= self.fsync_interval):
+            self.sync()
+        if self.file.tell() >= self.segment_bytes:
+            self.seal()
+    def sync(self):
+        """Write appended records through to disk"""
+        if self.file and self.unsynced:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        self.unsynced = 0
+        self.last_sync = time.time()
+    def seal(self):
+        """Close the current segment, making it available to read"""
+        if self.file:
+            self.sync()
+            self.file.close()
+            self.segments.append(self.path)
+            self.file = None
+            self.path = None
+    def sealed(self):
+        """Return the paths of sealed segments, oldest first"""
+        return list(self.segments)
+    def read(self, path, offset=0):
+        """Yield (offset, record) pairs for the records in segment `path`
+        from `offset`, where offset is that of the following record.
+
+        """
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            while True:
+                header = f.read(_RECORD_HEADER.size)
+                if len(header) < _RECORD_HEADER.size:
+                    break
+                (size,) = _RECORD_HEADER.unpack(header)
+                data = f.read(size)
+                if len(data) < size:
+                    break
+                offset += _RECORD_HEADER.size + size
+                yield (offset, data.decode('utf-8'))
+    def remove(self, path):
+        """Delete sealed segment `path`"""
+        self.segments.remove(path)
+        os.remove(path)
+    def empty(self):
+        """Indicate there are no records in the log"""
+        return not self.segments and self.file is None
+    def size(self):
+        """Return the number of bytes in the log.  This may be called
+        without the lock (eg by a metrics reporter), so segments removed
+        while it runs are counted as empty.
+
+        """
+        paths = list(self.segments) + ([self.path] if self.file else [])
+        size = 0
+        for path in paths:
+            try:
+                size += os.path.getsize(path)
+            except (OSError, TypeError):
+                pass
+        return size
+    def close(self):
+        self.seal()
+
+class SpillingSink(Sink):
+    """This is a sink that protects the collector from an unavailable or
+    slow downstream sink.  Records are written straight through to
+    `sink` until a write raises, or takes longer than `slow_seconds`
+    (if set).  From then on, records are appended to a `SpillLog` in
+    `directory`, and a background thread tries every `retry_interval`
+    seconds to replay the log to the sink, `batch_size` records at a
+    time with `write_many`.  Once the log has been drained, records are
+    written straight through again.
+
+    Only the current batch of records is ever held in memory.  Records
+    are delivered at least once: a batch that fails part way through is
+    retried whole.  Records still spilled on close stay on disk, and
+    are replayed by the next `SpillingSink` using the same directory.
+
+    A batch that fails `max_attempts` times in a row is retried a record
+    at a time, so that one bad record cannot hold up the log forever.
+    Records that fail on their own once another has been written (so
+    the sink is evidently up) are moved to a "quarantine" `SpillLog` in
+    `directory`, to be inspected and replayed by hand.
+
+    """
+    def __init__(self, sink, directory, retry_interval=30, slow_seconds=None,
+                 batch_size=1000, close_timeout=60, max_attempts=5,
+                 **log_options):
+        self.is_open = False
+        self.sink = sink
+        self.log = SpillLog(directory, **log_options)
+        self.quarantine = SpillLog(os.path.join(directory, 'quarantine'),
+                                   **log_options)
+        self.retry_interval = retry_interval
+        self.slow_seconds = slow_seconds
+        self.batch_size = batch_size
+        self.close_timeout = close_timeout
+        self.max_attempts = max_attempts
+        self.spilling = not self.log.empty()
+        self.sink_open = False
+        self.open_args = ()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closing = False
+        self._replayer = None
+        self._offset = 0
+        self._failed_batches = 0
+        self._quarantined = REGISTRY.counter(
+            'spill_quarantined', 'Spilled records that could not be replayed',
+            directory=directory)
+        REGISTRY.gauge('spill_bytes', 'Bytes waiting in a spill log',
+                       fn=self.log.size, directory=directory)
+    def open(self, *args):
+        self.open_args = args
+        self.is_open = True
+        with self._lock:
+            if not self.spilling:
+                try:
+                    self.sink.open(*args)
+                    self.sink_open = True
+                    return
+                except Exception as e:
+                    print("Sink unavailable, spilling to {0}: {1}".format(
+                        self.log.directory, e))
+            self._spill()
+    def write(self, string):
+        with self._lock:
+            if self.spilling:
+                self.log.append(string)
+                return
+        start = time.time()
+        try:
+            self.sink.write(string)
+        except Exception as e:
+            print("Sink write failed, spilling to {0}: {1}".format(
+                self.log.directory, e))
+            with self._lock:
+                self.log.append(string)
+                self._spill()
+            return
+        if self.slow_seconds and time.time() - start > self.slow_seconds:
+            print("Sink is behind, spilling to {0}".format(self.log.directory))
+            with self._lock:
+                self._spill()
+    def flush(self):
+        with self._lock:
+            if self.spilling:
+                self.log.sync()
+                return
+        self.sink.flush()
+    def close(self):
+        """Try once more to drain the log, waiting up to `close_timeout`
+        seconds, then close the downstream sink.
+
+        """
+        self._closing = True
+        replayer = self._replayer
+        if replayer and replayer.is_alive():
+            self._wake.set()
+            replayer.join(self.close_timeout)
+        with self._lock:
+            self.quarantine.close()
+            if self.spilling:
+                self.log.close()
+                print("{0} bytes left spilled in {1}".format(
+                    self.log.size(), self.log.directory))
+                if replayer and replayer.is_alive():
+                    # the replayer still owns the sink
+                    self.is_open = False
+                    return
+        if self.sink_open:
+            self.sink.close()
+            self.sink_open = False
+        self.is_open = False
+    def exists(self, path):
+        return self.sink.exists(path)
+    def _spill(self):
+        """Divert records to the log (the lock must be held)"""
+        self.spilling = True
+        if not self._closing and (self._replayer is None or
+                                  not self._replayer.is_alive()):
+            self._replayer = threading.Thread(target=self._replay_loop)
+            self._replayer.daemon = True
+            self._replayer.start()
+    def _replay_loop(self):
+        while True:
+            self._wake.wait(self.retry_interval)
+            self._wake.clear()
+            try:
+                if self._replay():
+                    return
+            except Exception as e:
+                print("Replay from {0} failed: {1}".format(
+                    self.log.directory, e))
+            if self._closing:
+                return
+    def _replay(self):
+        """Replay sealed segments to the sink, returning True once the log
+        is empty and records are again written straight through.
+
+        """
+        if not self.sink_open:
+            self.sink.open(*self.open_args)
+            self.sink_open = True
+        while True:
+            with self._lock:
+                if not self.log.sealed():
+                    if self.log.empty():
+                        self.spilling = False
+                        return True
+                    self.log.seal()
+                path = self.log.sealed()[0]
+            if self._failed_batches >= self.max_attempts:
+                self._replay_singly()
+                continue
+            batch = []
+            for (offset, record) in self.log.read(path, self._offset):
+                batch.append(record)
+                if len(batch) >= self.batch_size:
+                    self._write_batch(batch)
+                    self._offset = offset
+                    batch = []
+            if batch:
+                self._write_batch(batch)
+            self.sink.flush()
+            with self._lock:
+                self.log.remove(path)
+                self._offset = 0
+    def _write_batch(self, batch):
+        try:
+            self.sink.write_many(batch)
+        except Exception:
+            self._failed_batches += 1
+            raise
+        self._failed_batches = 0
+    def _replay_singly(self):
+        """Write the records at the head of the log one at a time, up to
+        the end of the segment where one is first written, quarantining
+        those that fail once one has been.  Raises if nothing could be
+        written, after `max_attempts` failures in a row or at the end of
+        the log.
+
+        """
+        with self._lock:
+            # so that records spilled since can show the sink is up
+            self.log.seal()
+            paths = self.log.sealed()
+        written = False
+        failed = []
+        offset = self._offset
+        for (i, path) in enumerate(paths):
+            for (_, record) in self.log.read(path, offset):
+                try:
+                    self.sink.write(record)
+                except Exception as e:
+                    if written:
+                        self._quarantine(record, e)
+                        continue
+                    # nothing written yet: a bad record or a down sink
+                    failed.append((record, e))
+                    if len(failed) >= self.max_attempts:
+                        raise
+                    continue
+                if not written:
+                    written = True
+                    for (bad, e) in failed:
+                        self._quarantine(bad, e)
+                    failed = []
+            offset = 0
+            if written:
+                self.sink.flush()
+                with self._lock:
+                    for done in paths[:i + 1]:
+                        self.log.remove(done)
+                    self._offset = 0
+                    self._failed_batches = 0
+                return
+        raise IOError("No spilled record could be written from {0}".format(
+            self.log.directory))
+    def _quarantine(self, record, error):
+        print("Quarantining a record that could not be written: {0}".format(
+            error))
+        self.quarantine.append(record)
+        self.quarantine.sync()
+        self._quarantined.inc()
+
+class SpillTest(unittest.TestCase):
+    class FlakySink(Sink):
+        def __init__(self):
+            self.down = False
+            self.bad = ()
+            self.records = []
+        def open(self, *args):
+            if self.down:
+                raise IOError("down")
+        def write(self, string):
+            if self.down:
+                raise IOError("down")
+            if string in self.bad:
+                raise ValueError("bad record")
+            self.records.append(string)
+        def flush(self):
+            pass
+        def close(self):
+            pass
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def wait_for(self, cond):
+        deadline = time.time() + 5
+        while not cond() and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(cond())
+
+    def test_SpillLog(self):
+        log = SpillLog(self.dir, segment_bytes=20)
+        for i in range(5):
+            log.append(u'record {0}'.format(i))
+        self.assertEqual(len(log.sealed()), 2)
+        log.close()
+        log = SpillLog(self.dir)
+        records = [record for path in log.sealed()
+                   for (_, record) in log.read(path)]
+        self.assertEqual(records, ['record {0}'.format(i) for i in range(5)])
+        # a torn final record is ignored
+        with open(log.sealed()[-1], 'ab') as f:
+            f.write(_RECORD_HEADER.pack(100) + b'partial')
+        self.assertEqual(len(list(log.read(log.sealed()[-1]))), 1)
+        # a segment removed behind the log's back counts as empty
+        os.remove(log.sealed()[0])
+        self.assertEqual(log.size(), sum(os.path.getsize(path)
+                                         for path in log.sealed()[1:]))
+
+    def test_SpillingSink(self):
+        flaky = SpillTest.FlakySink()
+        sink = SpillingSink(flaky, self.dir, retry_interval=0.01,
+                            batch_size=3, segment_bytes=50)
+        sink.open('x')
+        sink.write('a')
+        flaky.down = True
+        for r in 'bcdefgh':
+            sink.write(r)
+        self.assertTrue(sink.spilling)
+        self.assertEqual(flaky.records, ['a'])
+        flaky.down = False
+        self.wait_for(lambda: not sink.spilling)
+        sink.write('i')
+        sink.close()
+        self.assertEqual(''.join(flaky.records), 'abcdefghi')
+        self.assertTrue(SpillLog(self.dir).empty())
+
+    def test_restart(self):
+        flaky = SpillTest.FlakySink()
+        flaky.down = True
+        sink = SpillingSink(flaky, self.dir, retry_interval=60)
+        sink.open('x')
+        sink.write('a')
+        sink.write('b')
+        sink.close()
+        self.assertEqual(flaky.records, [])
+        flaky.down = False
+        sink = SpillingSink(flaky, self.dir, retry_interval=0.01)
+        sink.open('x')
+        sink.write('c')
+        self.wait_for(lambda: not sink.spilling)
+        sink.close()
+        self.assertEqual(flaky.records, ['a', 'b', 'c'])
+
+    def test_quarantine(self):
+        flaky = SpillTest.FlakySink()
+        flaky.bad = ('c',)
+        sink = SpillingSink(flaky, self.dir, retry_interval=0.01,
+                            batch_size=2, max_attempts=2)
+        sink.open('x')
+        flaky.down = True
+        for r in 'abcde':
+            sink.write(r)
+        flaky.down = False
+        self.wait_for(lambda: not sink.spilling)
+        sink.close()
+        self.assertEqual(flaky.records, ['a', 'b', 'd', 'e'])
+        quarantine = SpillLog(os.path.join(self.dir, 'quarantine'))
+        self.assertEqual([record for path in quarantine.sealed()
+                          for (_, record) in quarantine.read(path)], ['c'])
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+def main():
+    unittest.main()
+if __name__ == '__main__':
+    main()
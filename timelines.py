@@ -0,0 +1,166 @@
+from __future__ import print_function
+import unittest
+
+import tweepy
+
+from connections import mongo_client
+
+class TimelineFetcher(object):
+    """Fetches user timelines into a collection, remembering the newest
+    tweet id stored for each user so that later refreshes only ask
+    the API for tweets posted since then.
+
+    """
+    def __init__(self, api, tweets, state, tweet_limit=1000, page_size=200):
+        """`tweets` is the collection receiving one document per tweet.
+        `state` is the collection holding the newest tweet id
+        (`since_id`) fetched for each user, keyed by user id.
+        `tweet_limit` bounds the tweets fetched per user per call, and
+        `page_size` is the per-request count (the API limit is 200).
+        `api` is a `tweepy.API`, or anything with a `user_timeline`
+        method taking the same arguments.
+
+        """
+        self.api = api
+        self.tweets = tweets
+        self.state = state
+        self.tweet_limit = tweet_limit
+        self.page_size = page_size
+    def since_id(self, userid):
+        """Return the newest tweet id stored for `userid`, or None"""
+        row = self.state.find_one({'_id': userid})
+        if row:
+            return row.get('since_id')
+        return None
+    def fetch(self, userid, username):
+        """Fetch tweets for a user newer than the stored `since_id`,
+        returning the number of tweets stored.
+
+        The API returns the newest tweets first, so pages are read
+        back from the newest with `max_id`.  If `tweet_limit` is reached
+        before `since_id`, the point reached is stored with the state,
+        and the next call carries on paging back from there; the stored
+        `since_id` only advances once the gap has been closed.  (The
+        first fetch for a user just samples their newest tweets.)
+        Tweets are upserted by id, so re-reading part of a timeline
+        after an interruption is harmless.
+
+        """
+        row = self.state.find_one({'_id': userid}) or {}
+        since_id = row.get('since_id')
+        max_id = row.get('max_id')
+        newest = row.get('newest', since_id)
+        query_ops = {'user_id': userid,
+                     'count': self.page_size,
+                     'trim_user': True,
+                     'include_rts': False}
+        if since_id:
+            query_ops['since_id'] = since_id
+        stored = 0
+        caught_up = False
+        while stored < self.tweet_limit:
+            if max_id:
+                query_ops['max_id'] = max_id
+            try:
+                page = self.api.user_timeline(**query_ops)
+            except tweepy.TweepError as e:
+                s = ""
+                if e.response and e.response.status:
+                    s = e.response.status
+                print(e, s)
+                if s == 104:
+                    continue
+                return stored
+            except Exception as e:
+                print(e)
+                return stored
+            page = page[:self.tweet_limit - stored]
+            if not page:
+                caught_up = True
+                break
+            for tweet in page:
+                self.tweets.replace_one(
+                    {'_id': tweet.id},
+                    {'_id': tweet.id,
+                     'user': userid,
+                     'name': username,
+                     'text': tweet.text},
+                    upsert=True)
+                stored += 1
+                if newest is None or tweet.id > newest:
+                    newest = tweet.id
+            max_id = min(tweet.id for tweet in page) - 1
+        if caught_up or since_id is None:
+            if newest != since_id or 'max_id' in row:
+                self.state.update_one(
+                    {'_id': userid},
+                    {'$set': {'since_id': newest},
+                     '$unset': {'max_id': '', 'newest': ''}},
+                    upsert=True)
+        else:
+            self.state.update_one(
+                {'_id': userid},
+                {'$set': {'max_id': max_id, 'newest': newest}},
+                upsert=True)
+        return stored
+    def refresh(self, users):
+        """Fetch new tweets for each (userid, username) pair in `users`,
+        returning the total number of tweets stored.
+
+        """
+        total = 0
+        for (userid, username) in users:
+            total += self.fetch(userid, username)
+        return total
+
+class TimelineFetcherTest(unittest.TestCase):
+    class Status(object):
+        def __init__(self, id):
+            self.id = id
+            self.text = 'tweet {0}'.format(id)
+
+    class API(object):
+        """Serves a timeline of tweets with ids 1 to `self.last`"""
+        def __init__(self):
+            self.last = 0
+        def user_timeline(self, user_id, count, since_id=None, max_id=None,
+                          **kwargs):
+            top = min(self.last, max_id or self.last)
+            bottom = max(since_id or 0, top - count)
+            return [TimelineFetcherTest.Status(id)
+                    for id in range(top, bottom, -1)]
+
+    def setUp(self):
+        self.db = mongo_client().test_db
+        self.api = TimelineFetcherTest.API()
+        self.fetcher = TimelineFetcher(self.api, self.db.test_timelines,
+                                       self.db.test_timeline_state,
+                                       tweet_limit=3, page_size=2)
+
+    def stored(self):
+        return sorted(doc['_id'] for doc in self.db.test_timelines.find())
+
+    def test_fetch(self):
+        self.api.last = 5
+        # the first fetch samples the newest tweets
+        self.assertEqual(self.fetcher.fetch(1, 'someone'), 3)
+        self.assertEqual(self.fetcher.since_id(1), 5)
+        # 7 new tweets take three calls at 3 per call, with no gap
+        self.api.last = 12
+        self.assertEqual(self.fetcher.fetch(1, 'someone'), 3)
+        self.assertEqual(self.fetcher.since_id(1), 5)
+        self.assertEqual(self.fetcher.fetch(1, 'someone'), 3)
+        self.assertEqual(self.fetcher.fetch(1, 'someone'), 1)
+        self.assertEqual(self.fetcher.since_id(1), 12)
+        self.assertEqual(self.stored(), list(range(3, 13)))
+        self.assertEqual(self.fetcher.refresh([(1, 'someone')]), 0)
+        self.assertEqual(self.db.test_timeline_state.find_one({'_id': 1}),
+                         {'_id': 1, 'since_id': 12})
+
+    def tearDown(self):
+        mongo_client().drop_database('test_db')
+
+def main():
+    unittest.main()
+if __name__ == '__main__':
+    main()